@@ -0,0 +1,374 @@
+# Copyright (c) 2015 Robert Collins <robertc@robertcollins.net>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Benchmarks for shellvars.
+
+Run from the root of the source tree::
+
+  python benchmarks/bench_shellvars.py --output results.json
+
+Each case of a representative corpus is measured separately for parsing
+(optionally with the parsley reference grammar too, using --reference),
+evaluating an already compiled template with each backend and after
+specializing it with all of the case's variables, and end to end
+evaluate() calls with the parse cache both cold and warm. The memory
+allocated by a call is measured with tracemalloc, as is the memory held by a
+compiled template and by the tree of nodes it was built from. The time to
+import shellvars in a fresh interpreter is measured too, as is the time for a
+fresh interpreter to compile 50,000 templates or to load them from a
+catalogue, and the throughput of evaluate() called from several threads at
+once, which scales with the number of threads on a free-threaded
+interpreter.
+
+Results are written as JSON, and two results files can be compared::
+
+  python benchmarks/bench_shellvars.py --compare before.json after.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import sysconfig
+import tempfile
+import threading
+import timeit
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import shellvars
+from shellvars import CODEGEN, EMPTY, SKIP
+
+
+def _nested(depth):
+    expression = 'leaf'
+    for level in reversed(range(depth)):
+        op = ':=' if level % 2 else ':-'
+        expression = '${n%d%s%s}' % (level, op, expression)
+    return expression
+
+
+def corpus():
+    """Return the benchmark cases: (name, expression, variables, absent)."""
+    environment = dict(('VAR%d' % i, 'value%d' % i) for i in range(5000))
+    return [
+        ('short_var', '$HOME', {'HOME': '/home/user'}, EMPTY),
+        ('short_mixed', 'pre ${USER} mid $HOME post',
+         {'USER': 'user', 'HOME': '/home/user'}, EMPTY),
+        ('literal_blob',
+         ('x' * 1000 + ' $VAR ${OTHER:-default} ') * 8,
+         {'VAR': 'value'}, EMPTY),
+        ('nested_chain', _nested(20), {}, EMPTY),
+        ('skip_many_absent',
+         ' '.join('$ABSENT%d ${MISSING%d:-x}' % (i, i) for i in range(100)),
+         {}, SKIP),
+        ('huge_variables',
+         '$VAR1 ${VAR2500} ${VAR4999:-none} ${UNSET:=set}',
+         environment, EMPTY),
+        ]
+
+
+def _time(function, repeat):
+    """Return the best time of one call to function, in microseconds."""
+    timer = timeit.Timer(function)
+    number, _ = timer.autorange()
+    best = min(timer.repeat(repeat=repeat, number=number))
+    return best / number * 1e6
+
+
+def _peak_memory(function, calls=20):
+    """Return the most memory allocated during a call to function, in bytes.
+
+    This includes the result of the call and everything allocated and freed
+    while computing it.
+    """
+    function()
+    tracemalloc.start()
+    try:
+        peak = 0
+        for _ in range(calls):
+            current = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            result = function()
+            peak = max(peak, tracemalloc.get_traced_memory()[1] - current)
+            del result
+    finally:
+        tracemalloc.stop()
+    return peak
+
+
+def _retained_memory(function):
+    """Return the memory held by the result of function, in bytes."""
+    function()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        result = function()
+        retained = tracemalloc.get_traced_memory()[0] - before
+        del result
+    finally:
+        tracemalloc.stop()
+    return retained
+
+
+def _uncached(function):
+    def uncached():
+        shellvars.cache_clear()
+        return function()
+    return uncached
+
+
+def measure_case(expression, variables, absent, repeat, reference):
+    template = shellvars.compile(expression)
+    generated = shellvars.compile(expression, CODEGEN)
+    specialized = template.specialize(variables)
+    evaluate = lambda: shellvars.evaluate(expression, variables, absent)
+    evaluate_template = lambda: template.evaluate(variables, absent)
+    parse = lambda: shellvars._scan(expression)
+    results = {
+        'expression_length': len(expression),
+        'parse_us': _time(parse, repeat),
+        'parse_peak_bytes': _peak_memory(parse),
+        'nodes_bytes': _retained_memory(parse),
+        'template_bytes': _retained_memory(
+            lambda: shellvars.Template(expression, parse())),
+        'evaluate_us': _time(evaluate_template, repeat),
+        'evaluate_peak_bytes': _peak_memory(evaluate_template),
+        'evaluate_codegen_us': _time(
+            lambda: generated.evaluate(variables, absent), repeat),
+        'evaluate_specialized_us': _time(
+            lambda: specialized.evaluate({}, absent), repeat),
+        'end_to_end_cold_us': _time(_uncached(evaluate), repeat),
+        'end_to_end_cold_peak_bytes': _peak_memory(_uncached(evaluate)),
+        'end_to_end_warm_us': _time(evaluate, repeat),
+        }
+    if reference:
+        results['parse_reference_us'] = _time(
+            lambda: shellvars._grammar(expression).string(), 1)
+    return results
+
+
+def measure_import(repeat=5):
+    """Return the best time to import shellvars, in milliseconds."""
+    return _time_script("import shellvars\n", repeat)
+
+
+def measure_startup(count=50000):
+    """Return the time for a fresh process to get ready to evaluate count
+    templates: by compiling them all, or by loading a saved catalogue and
+    looking up one of them. Times are in milliseconds.
+    """
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'templates.shvc')
+        expressions = [
+            'pre ${VAR%d:-${OTHER%d:=default}} $HOME/%d' % (i, i, i)
+            for i in range(count)]
+        shellvars.save_catalogue(expressions, path)
+        source = os.path.join(directory, 'templates.txt')
+        with open(source, 'w') as f:
+            f.write(''.join(e + '\n' for e in expressions))
+        compile_all = (
+            "import shellvars\n"
+            "shellvars.set_cache_size(0)\n"
+            "templates = dict(\n"
+            "    (e, shellvars.compile(e))\n"
+            "    for e in open(%r).read().splitlines())\n" % (source,))
+        load = (
+            "import shellvars\n"
+            "catalogue = shellvars.load_catalogue(%r)\n"
+            "catalogue[%r].evaluate({})\n" % (path, expressions[count // 2]))
+        return {
+            'templates': count,
+            'catalogue_bytes': os.path.getsize(path),
+            'startup_compile_ms': _time_script(compile_all),
+            'startup_catalogue_ms': _time_script(load),
+            }
+    finally:
+        shutil.rmtree(directory)
+
+
+def _free_threaded():
+    """Return whether the interpreter is running without the GIL."""
+    is_gil_enabled = getattr(sys, '_is_gil_enabled', None)
+    return bool(
+        sysconfig.get_config_var('Py_GIL_DISABLED')
+        and is_gil_enabled is not None and not is_gil_enabled())
+
+
+def measure_threads(calls=20000, repeat=3):
+    """Return the throughput of evaluate() called from several threads at
+    once, in evaluations per second, for 1, 2, 4 and so on threads up to at
+    least the number of CPUs.
+
+    Each thread evaluates the cases of the corpus in turn, with the parse
+    cache warm, so this measures cached lookups and evaluation: with the GIL
+    it should not change with the number of threads, and without it it
+    should grow with the number of threads up to the number of CPUs.
+    """
+    cases = [
+        (expression, variables, absent)
+        for name, expression, variables, absent in corpus()
+        if name in ('short_var', 'short_mixed', 'nested_chain')]
+    for expression, variables, absent in cases:
+        shellvars.evaluate(expression, variables, absent)
+
+    def work(barrier):
+        barrier.wait()
+        for i in range(calls):
+            expression, variables, absent = cases[i % len(cases)]
+            shellvars.evaluate(expression, variables, absent)
+        barrier.wait()
+
+    results = {}
+    counts = [1]
+    while counts[-1] < max(4, os.cpu_count() or 1):
+        counts.append(counts[-1] * 2)
+    for count in counts:
+        best = None
+        for _ in range(repeat):
+            barrier = threading.Barrier(count + 1)
+            threads = [
+                threading.Thread(target=work, args=(barrier,))
+                for _ in range(count)]
+            for thread in threads:
+                thread.start()
+            barrier.wait()
+            start = timeit.default_timer()
+            barrier.wait()
+            seconds = timeit.default_timer() - start
+            for thread in threads:
+                thread.join()
+            best = seconds if best is None else min(best, seconds)
+        results['evaluate_%d_threads_per_s' % (count,)] = (
+            count * calls / best)
+    return results
+
+
+def _time_script(script, repeat=3):
+    """Return the best time to run script in a fresh interpreter, in
+    milliseconds.
+    """
+    script = (
+        "import time\n"
+        "start = time.time()\n"
+        "%s"
+        "print(time.time() - start)\n") % (script,)
+    root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+    times = []
+    for _ in range(repeat):
+        output = subprocess.check_output(
+            [sys.executable, '-c', script], cwd=root)
+        times.append(float(output) * 1e3)
+    return min(times)
+
+
+def _commit():
+    try:
+        output = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.STDOUT)
+    except (EnvironmentError, subprocess.CalledProcessError):
+        return None
+    return output.decode('ascii').strip()
+
+
+def run(cases, repeat, reference):
+    results = {
+        'python': platform.python_implementation() + ' ' + sys.version.split()[0],
+        'commit': _commit(),
+        'import_ms': measure_import(),
+        'free_threaded': _free_threaded(),
+        'startup': measure_startup(),
+        'threads': measure_threads(),
+        'cases': {},
+        }
+    for name, expression, variables, absent in corpus():
+        if cases and name not in cases:
+            continue
+        results['cases'][name] = measure_case(
+            expression, variables, absent, repeat, reference)
+    return results
+
+
+def compare(before, after, out):
+    """Write a table comparing two results to out."""
+    out.write('%-40s %14s %14s %8s\n' % ('metric', 'before', 'after', 'ratio'))
+    rows = [('import_ms', before.get('import_ms'), after.get('import_ms'))]
+    for group in ('startup', 'threads'):
+        for metric in sorted(after.get(group, {})):
+            rows.append((
+                '%s.%s' % (group, metric),
+                before.get(group, {}).get(metric),
+                after[group][metric]))
+    for case in sorted(after['cases']):
+        for metric in sorted(after['cases'][case]):
+            rows.append((
+                '%s.%s' % (case, metric),
+                before.get('cases', {}).get(case, {}).get(metric),
+                after['cases'][case][metric]))
+    for name, old, new in rows:
+        if old is None or new is None:
+            continue
+        ratio = '%.2fx' % (new / old,) if old else '-'
+        out.write('%-40s %14.2f %14.2f %8s\n' % (name, old, new, ratio))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument(
+        '--output', help='Write the results to this file as JSON.')
+    parser.add_argument(
+        '--case', action='append', default=[],
+        help='Only run this case. May be given more than once.')
+    parser.add_argument(
+        '--repeat', type=int, default=3,
+        help='How many times to repeat each timing, keeping the best.')
+    parser.add_argument(
+        '--reference', action='store_true',
+        help='Also time parsing with the parsley reference grammar (slow).')
+    parser.add_argument(
+        '--compare', nargs=2, metavar=('BEFORE', 'AFTER'),
+        help='Compare two results files rather than running benchmarks.')
+    args = parser.parse_args(argv)
+    if args.compare:
+        with open(args.compare[0]) as f:
+            before = json.load(f)
+        with open(args.compare[1]) as f:
+            after = json.load(f)
+        compare(before, after, sys.stdout)
+        return 0
+    results = run(args.case, args.repeat, args.reference)
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        sys.stdout.write(text + '\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
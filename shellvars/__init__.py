@@ -20,37 +20,307 @@
 
 """Evaluate shell variable expressions."""
 
-__all__ = ['evaluate', 'EMPTY', 'SKIP', 'EvaluationError']
+__all__ = [
+    'Analysis',
+    'analyze',
+    'BulkResult',
+    'CacheInfo',
+    'Catalogue',
+    'CatalogueError',
+    'cache_clear',
+    'CODEGEN',
+    'cache_info',
+    'compile',
+    'CycleError',
+    'evaluate',
+    'evaluate_bulk',
+    'evaluate_columns',
+    'evaluate_files',
+    'evaluate_async',
+    'evaluate_many',
+    'evaluate_stream',
+    'EMPTY',
+    'Environment',
+    'SKIP',
+    'EvaluationError',
+    'INTERPRET',
+    'instrument',
+    'Instrumentation',
+    'load_catalogue',
+    'Resolver',
+    'ResultCache',
+    'Template',
+    'save_catalogue',
+    'set_cache_size',
+    ]
 
 from collections import namedtuple
+import re
+import sys
+import threading
+import time
 
-import parsley
-from parsley import makeGrammar
+_builtin_compile = compile
+try:
+    _intern = sys.intern
+except AttributeError:
+    _intern = intern
 
 _Literal = namedtuple("_Literal", "value")
 _SimpleExpression = namedtuple("_SimpleExpression", "name text")
-_Expression = namedtuple("Expression", "name null op word text")
+_Expression = namedtuple("Expression", "name null op word")
 
 
+# The reference grammar for shell expressions. Expressions are parsed with
+# _scan, which is much faster; the tests check that both agree. Nothing but
+# the tests uses the grammar, so it plays no part in thread safety.
 _grammar_text = """
 name = <(letter|'_')(letterOrDigit|'_')*>
 expr = simple_expr | simple_brackets | default_expr
 simple_expr = <('$' name:name)>:text -> SimpleExpression(name, text)
 simple_brackets = <'$' '{' name:name '}' >:text -> SimpleExpression(name, text)
-default_expr = < '$' '{' name:name ':'?:null <'-'|'='|'?'|'+'>:op nestedtokens:word '}' >:text -> Expression(name, null, op, word, text)
+default_expr = '$' '{' name:name ':'?:null <'-'|'='|'?'|'+'>:op nestedtokens:word '}' -> Expression(name, null, op, word)
 notexpr = <(~expr anything)+>:value -> Literal(value)
 string = tokens:tokens end -> tokens
 tokens = (expr | notexpr)*:tokens -> tokens
 nestedtokens = (expr | not_expr_no_endbrace )*:tokens -> tokens
 not_expr_no_endbrace = <(~expr ~'}' anything)+>:value -> Literal(value)
 """
-_grammar = makeGrammar(_grammar_text, {
-    'Expression': _Expression,
-    'SimpleExpression': _SimpleExpression,
-    'Literal': _Literal,
-    })
+_parser = None
 
 
+def _grammar(text):
+    """Return a parser for text using the reference grammar.
+
+    Importing parsley and building the grammar is slow, so it is only done
+    the first time the reference grammar is used.
+    """
+    global _parser
+    if _parser is None:
+        from parsley import makeGrammar
+        _parser = makeGrammar(_grammar_text, {
+            'Expression': _Expression,
+            'SimpleExpression': _SimpleExpression,
+            'Literal': _Literal,
+            })
+    return _parser(text)
+
+
+_ops = '-=?+'
+
+
+class _Syntax(object):
+    """The characters of expressions of one type, str or bytes."""
+
+    def __init__(self, dollar, open_brace, close_brace, colon, underscore, ops,
+                 name_tail):
+        self.dollar = dollar
+        self.open_brace = open_brace
+        self.close_brace = close_brace
+        self.colon = colon
+        self.underscore = underscore
+        self.ops = ops
+        self.name_tail = name_tail
+        self.empty = dollar[:0]
+
+
+_text_syntax = _Syntax(
+    '$', '{', '}', ':', '_', _ops, re.compile(r'\w*', re.UNICODE))
+# Names in bytes expressions are ASCII.
+_bytes_syntax = _Syntax(
+    b'$', b'{', b'}', b':', b'_', _ops.encode('ascii'), re.compile(br'\w*'))
+
+
+def _syntax(expression):
+    """Return the _Syntax of expression."""
+    if isinstance(expression, bytes) and not isinstance(expression, str):
+        return _bytes_syntax
+    return _text_syntax
+
+
+def _match_start(expression, pos, syntax=_text_syntax):
+    """Match the start of an expression at pos, which must hold '$'.
+
+    :return: None if no expression starts at pos, or _truncated if that
+        depends on text after the end of expression. Otherwise a tuple (node,
+        end) for a complete $name or ${name} expression, or (frame, end) for
+        the opening '${name:op' of an expression whose word starts at end.
+        frame is a tuple (name, null, op). null and op are always str.
+    """
+    length = len(expression)
+    start = pos + 1
+    if start == length:
+        return _truncated
+    char = expression[start:start + 1]
+    if char == syntax.open_brace:
+        start += 1
+        if start == length:
+            return _truncated
+        char = expression[start:start + 1]
+        braced = True
+    else:
+        braced = False
+    if not (char.isalpha() or char == syntax.underscore):
+        return None
+    end = syntax.name_tail.match(expression, start + 1).end()
+    name = expression[start:end]
+    if not braced:
+        return _SimpleExpression(name, expression[pos:end]), end
+    if end == length:
+        return _truncated
+    char = expression[end:end + 1]
+    if char == syntax.close_brace:
+        end += 1
+        return _SimpleExpression(name, expression[pos:end]), end
+    if char == syntax.colon:
+        null = ':'
+        end += 1
+        if end == length:
+            return _truncated
+        char = expression[end:end + 1]
+    else:
+        null = None
+    op = syntax.ops.find(char)
+    if op == -1:
+        return None
+    return (name, null, _ops[op]), end + 1
+
+
+def _scan(expression, final=True):
+    """Parse expression into a list of nodes.
+
+    This produces the same nodes as _grammar(expression).string(), but in a
+    single pass: literal text is skipped with str.find rather than by trying
+    to match an expression at every character.
+
+    An expression like '${name:-' that is never closed is not an expression at
+    all, and its text is literal. As the word of an expression can only be
+    ended by '}', the only way for an opened expression to fail is to reach
+    the end of the string. At that point every still open expression is
+    folded back into literal text, along with the nodes parsed in its word:
+    with no '}' left to end them, those words parse exactly as they would
+    outside an expression.
+
+    Expressions may be str or bytes. The text of the nodes of a bytes
+    expression is bytes too, but the null and op of _Expression nodes are
+    always str.
+
+    :param final: If False, expression is only the start of the text to
+        parse, and a tuple (nodes, end) is returned instead: nodes are the
+        nodes of expression[:end], which no following text can change.
+    """
+    syntax = _syntax(expression)
+    length = len(expression)
+    # The nodes of the innermost open expression, or the result.
+    nodes = []
+    # Open expressions: (parent nodes, start, word start, name, null, op).
+    stack = []
+    literal_start = pos = 0
+    # The position of the next '}' (length if there is none), cached as it
+    # is only needed inside expressions.
+    close = -1
+    # Where the text whose parse may still change starts, if not final.
+    cut = length
+    while True:
+        dollar = expression.find(syntax.dollar, pos)
+        if stack:
+            if close < pos:
+                close = expression.find(syntax.close_brace, pos)
+                if close == -1:
+                    close = length
+            if close < length and (dollar == -1 or close < dollar):
+                if literal_start < close:
+                    nodes.append(_Literal(expression[literal_start:close]))
+                parent, start, _, name, null, op = stack.pop()
+                pos = literal_start = close + 1
+                parent.append(_Expression(name, null, op, nodes))
+                nodes = parent
+                continue
+        if dollar == -1:
+            break
+        match = _match_start(expression, dollar, syntax)
+        if match is None or match is _truncated:
+            if match is _truncated and not final:
+                cut = dollar
+                break
+            pos = dollar + 1
+            continue
+        node, pos = match
+        if (pos == length and not final and type(node) is _SimpleExpression
+                and expression[dollar + 1:dollar + 2] != syntax.open_brace):
+            # More text could continue the name.
+            cut = dollar
+            break
+        if literal_start < dollar:
+            nodes.append(_Literal(expression[literal_start:dollar]))
+        literal_start = pos
+        if type(node) is _SimpleExpression:
+            nodes.append(node)
+        else:
+            stack.append((nodes, dollar, pos) + node)
+            nodes = []
+    if not final:
+        if stack:
+            # The outermost open expression may yet be closed.
+            return stack[0][0], stack[0][1]
+        if literal_start < cut:
+            nodes.append(_Literal(expression[literal_start:cut]))
+        return nodes, cut
+    if literal_start < length:
+        nodes.append(_Literal(expression[literal_start:]))
+    if not stack:
+        return nodes
+    # Fold the open expressions, outermost first, back into literal text.
+    stack.append((nodes,))
+    result = stack[0][0]
+    parts = []
+    if result and type(result[-1]) is _Literal:
+        parts.append(result.pop().value)
+    for frame, inner in zip(stack, stack[1:]):
+        parts.append(expression[frame[1]:frame[2]])
+        for node in inner[0]:
+            if type(node) is _Literal:
+                parts.append(node.value)
+            else:
+                result.append(_Literal(syntax.empty.join(parts)))
+                parts = []
+                result.append(node)
+    if parts:
+        result.append(_Literal(syntax.empty.join(parts)))
+    return result
+
+def _source(node):
+    """Return the text node was parsed from.
+
+    Expressions do not keep a copy of their text, as the text of nested
+    expressions would then be stored once for every level of nesting.
+    """
+    if type(node) == _Literal:
+        return node.value
+    if type(node) == _SimpleExpression:
+        return node.text
+    syntax = _syntax(node.name)
+    parts = []
+    # Nodes, and the '}' ending each expression, in reverse order.
+    pending = [node]
+    while pending:
+        node = pending.pop()
+        if type(node) == _Literal:
+            parts.append(node.value)
+        elif type(node) == _SimpleExpression:
+            parts.append(node.text)
+        elif type(node) == _Expression:
+            op = _ops.index(node.op)
+            parts.extend((
+                syntax.dollar, syntax.open_brace, node.name,
+                syntax.colon if node.null else syntax.empty,
+                syntax.ops[op:op + 1]))
+            pending.append(syntax.close_brace)
+            pending.extend(reversed(node.word))
+        else:
+            parts.append(node)
+    return syntax.empty.join(parts)
+
 class _Constant:
     def __init__(self, name):
         self.name = name
@@ -59,17 +329,1280 @@ class _Constant:
 EMPTY = _Constant('EMPTY')
 SKIP = _Constant('SKIP')
 _sentinel = _Constant('sentinel')
+_truncated = _Constant('truncated')
+INTERPRET = _Constant('INTERPRET')
+CODEGEN = _Constant('CODEGEN')
 
 
 class EvaluationError(Exception):
     pass
 
 
+def _message(value):
+    """Return value, text from a str or bytes expression, as str."""
+    if isinstance(value, bytes) and not isinstance(value, str):
+        return value.decode('utf-8', 'replace')
+    return value
+
+
+def _check_absent(absent):
+    if absent not in (EMPTY, SKIP):
+        raise ValueError("invalid value for absent %r" % (absent,))
+
+
+# The instructions of a _Program, and their operands:
+# _LITERAL index: the text constants[index].
+# _VARIABLE name start end: a _SimpleExpression, whose text is
+#   expression[start:end].
+# _EXPRESSION name null op start end next: an _Expression whose text is
+#   expression[start:end]. null is 1 for ':' and op indexes _ops. Its word
+#   follows, ended by an _END instruction, and next is the position after
+#   that _END.
+# name operands index the names of the program.
+_LITERAL, _VARIABLE, _EXPRESSION, _END = range(4)
+# The number of codes in each instruction, by its opcode.
+_sizes = (2, 4, 7, 1)
+_DEFAULT, _ASSIGN, _ERROR, _ALTERNATIVE = range(len(_ops))
+
+
+class _Program(object):
+    """A parsed expression as a flat tuple of instructions.
+
+    This takes much less memory than a tree of nodes: each name is stored
+    once and interned, the text of expressions, which is only needed when
+    absent is SKIP, is referred to by its offsets in the expression, and
+    there are no per-node objects at all. Literal text is kept in constants
+    rather than sliced from the expression, so evaluating it copies nothing.
+    """
+
+    __slots__ = ('expression', 'empty', 'names', 'constants', 'code',
+                 'assigns')
+
+    def __init__(self, expression, names, constants, code, assigns):
+        self.expression = expression
+        # '' or b'', as the expression is str or bytes.
+        self.empty = expression[:0]
+        self.names = names
+        self.constants = constants
+        self.code = code
+        # Whether the program has any _ASSIGN expressions.
+        self.assigns = assigns
+
+
+def _assemble(expression, nodes):
+    """Return the _Program for nodes, which were parsed from expression.
+
+    expression may continue after the text of nodes.
+    """
+    names = {}
+    constants = []
+    code = []
+    assigns = False
+    # The position of each _EXPRESSION whose _END has not been reached.
+    expressions = []
+    # Nodes, and None for the end of each expression, in reverse order.
+    pending = list(reversed(nodes))
+    pos = 0
+    while pending:
+        node = pending.pop()
+        if node is None:
+            pos += 1
+            start = expressions.pop()
+            code.append(_END)
+            code[start + 5] = pos
+            code[start + 6] = len(code)
+        elif type(node) == _Literal:
+            code.extend((_LITERAL, len(constants)))
+            constants.append(node.value)
+            pos += len(node.value)
+        else:
+            name = node.name
+            if type(name) is str:
+                name = _intern(name)
+            name = names.setdefault(name, len(names))
+            if type(node) == _SimpleExpression:
+                code.extend((_VARIABLE, name, pos, pos + len(node.text)))
+                pos += len(node.text)
+            else:
+                expressions.append(len(code))
+                null = node.null is not None
+                operation = _ops.index(node.op)
+                assigns = assigns or operation == _ASSIGN
+                code.extend((_EXPRESSION, name, null, operation, pos, 0, 0))
+                pos += len(node.name) + null + 3
+                pending.append(None)
+                pending.extend(reversed(node.word))
+    return _Program(
+        expression, tuple(sorted(names, key=names.get)), tuple(constants),
+        tuple(code), assigns)
+
+
+def _disassemble(program):
+    """Return the nodes of program."""
+    expression = program.expression
+    names = program.names
+    constants = program.constants
+    code = program.code
+    nodes = []
+    # (parent nodes, position) for each _EXPRESSION being disassembled.
+    stack = []
+    pc = 0
+    while pc < len(code):
+        op = code[pc]
+        if op == _LITERAL:
+            nodes.append(_Literal(constants[code[pc + 1]]))
+            pc += 2
+        elif op == _VARIABLE:
+            nodes.append(_SimpleExpression(
+                names[code[pc + 1]], expression[code[pc + 2]:code[pc + 3]]))
+            pc += 4
+        elif op == _EXPRESSION:
+            stack.append((nodes, pc))
+            nodes = []
+            pc += 7
+        else:
+            parent, start = stack.pop()
+            parent.append(_Expression(
+                names[code[start + 1]], ':' if code[start + 2] else None,
+                _ops[code[start + 3]], nodes))
+            nodes = parent
+            pc += 1
+    return nodes
+
+
+class Template(object):
+    """A parsed shell expression that can be evaluated many times.
+
+    Use ``compile`` to create a Template. Evaluating a Template does not parse
+    the expression again, so it is the cheapest way to render the same
+    expression with many different sets of variables.
+
+    :ivar expression: The expression text the Template was compiled from.
+    """
+
+    __slots__ = ('expression', '_analysis', '_assigns', '_program')
+
+    def __init__(self, expression, nodes):
+        self.expression = expression
+        self._analysis = None
+        self._program = _assemble(expression, nodes)
+        self._assigns = self._program.assigns
+
+    @property
+    def analysis(self):
+        """The Analysis of the expression, computed when first needed."""
+        if self._analysis is None:
+            self._analysis = _analyze(self.nodes)
+        return self._analysis
+
+    @property
+    def nodes(self):
+        """The parsed expression: a list of _Literal, _SimpleExpression and
+        _Expression nodes.
+
+        Templates do not keep these, so they are rebuilt on each access.
+        """
+        return _disassemble(self._program)
+
+    def __repr__(self):
+        return 'Template(%r)' % (self.expression,)
+
+    def evaluate(self, variables, absent=EMPTY):
+        """Evaluate the template with variables.
+
+        See ``evaluate`` for the meaning of the parameters and the result.
+        """
+        _check_absent(absent)
+        if _instrumentation is not None:
+            return _instrumentation._evaluate(self, variables, absent)
+        if self._assigns:
+            variables = _Overlay(variables)
+        return _evaluate(self._program, variables, absent)
+
+    def _evaluate_counted(self, variables, absent, stats):
+        """Evaluate the template, counting the nodes visited in stats."""
+        if self._assigns:
+            variables = _Overlay(variables)
+        return _evaluate(self._program, variables, absent, stats)
+
+    def evaluate_many(self, variable_sets, absent=EMPTY):
+        """Evaluate the template with each of several sets of variables.
+
+        :param variable_sets: An iterable of variable mappings.
+        :param absent: As for ``evaluate``.
+        :return: An iterator of (string, dict) tuples, one for each mapping
+            in variable_sets, produced as the iterator is consumed.
+        """
+        _check_absent(absent)
+        return self._evaluate_many(variable_sets, absent)
+
+    def _evaluate_many(self, variable_sets, absent):
+        program = self._program
+        if _instrumentation is not None:
+            for variables in variable_sets:
+                yield self.evaluate(variables, absent)
+        elif self._assigns:
+            for variables in variable_sets:
+                yield _evaluate(program, _Overlay(variables), absent)
+        else:
+            for variables in variable_sets:
+                yield _evaluate(program, variables, absent)
+
+    def evaluate_columns(self, columns, absent=EMPTY):
+        """Evaluate the template once for each row of a table of variables.
+
+        :param columns: A mapping from variable name to a sequence of values
+            for that variable, one per row. All the sequences must have the
+            same length.
+        :param absent: As for ``evaluate``.
+        :return: An iterator of (string, dict) tuples, one for each row.
+        """
+        _check_absent(absent)
+        names = list(columns)
+        values = [columns[name] for name in names]
+        lengths = set(len(column) for column in values)
+        if len(lengths) > 1:
+            raise ValueError("columns have different lengths %r" % (
+                dict(zip(names, [len(column) for column in values])),))
+        rows = (dict(zip(names, row)) for row in zip(*values))
+        return self._evaluate_many(rows, absent)
+
+    def specialize(self, known):
+        """Partially evaluate the template with the variables known so far.
+
+        Everything that depends only on known variables is evaluated now,
+        leaving a smaller template that only looks up the other variables.
+        Evaluating it with variables gives the same result as evaluating
+        this template with variables and known together, the values in
+        known taking precedence, including the assignments made and the
+        text kept for unset variables when absent is SKIP.
+
+        :param known: A mapping of the variables that are known. They are
+            all set.
+        :return: A Template. It evaluates the program it was specialized to
+            rather than generating code.
+        """
+        return _specialize(self, known)
+
+
+class _Overlay(object):
+    """Variables with the assignments made by an expression layered on top.
+
+    This lets an expression assign variables without copying or modifying
+    the mapping it was given. The layer is only created by the first
+    assignment.
+    """
+
+    __slots__ = ('variables', 'assigned')
+
+    def __init__(self, variables):
+        self.variables = variables
+        self.assigned = None
+
+    def get(self, name, default=None):
+        if self.assigned is not None:
+            value = self.assigned.get(name, _sentinel)
+            if value is not _sentinel:
+                return value
+        return self.variables.get(name, default)
+
+    def __setitem__(self, name, value):
+        if self.assigned is None:
+            self.assigned = {}
+        self.assigned[name] = value
+
+
+class _Bound(object):
+    """Variables with some bound to fixed values."""
+
+    __slots__ = ('bindings', 'variables')
+
+    def __init__(self, bindings, variables):
+        self.bindings = bindings
+        self.variables = variables
+
+    def get(self, name, default=None):
+        value = self.bindings.get(name, _sentinel)
+        if value is _sentinel:
+            return self.variables.get(name, default)
+        return value
+
+
+class _ResidualTemplate(Template):
+    """What is left of a Template after Template.specialize.
+
+    :ivar expression: The expression of the specialized Template.
+    """
+
+    __slots__ = ('_bindings', '_assignments')
+
+    def __init__(self, expression, program, bindings, assignments):
+        self.expression = expression
+        self._analysis = None
+        self._program = program
+        self._assigns = program.assigns
+        # Values the program looks up but that were known: they can not be
+        # folded as the program may assign them.
+        self._bindings = bindings
+        # The assignments made while specializing.
+        self._assignments = assignments
+
+    def __repr__(self):
+        return 'Template(%r, specialized)' % (self.expression,)
+
+    def evaluate(self, variables, absent=EMPTY):
+        _check_absent(absent)
+        if _instrumentation is not None:
+            return _instrumentation._evaluate(self, variables, absent)
+        return self._evaluate_counted(variables, absent, None)
+
+    def _evaluate_counted(self, variables, absent, stats):
+        if self._bindings:
+            variables = _Bound(self._bindings, variables)
+        if self._assigns:
+            variables = _Overlay(variables)
+        value, assignments = _evaluate(
+            self._program, variables, absent, stats)
+        if self._assignments:
+            assignments, assigned = dict(self._assignments), assignments
+            assignments.update(assigned)
+        return value, assignments
+
+    def _evaluate_many(self, variable_sets, absent):
+        for variables in variable_sets:
+            yield self.evaluate(variables, absent)
+
+    def specialize(self, known):
+        known = dict(known)
+        known.update(self._bindings)
+        residual = _specialize(self, known)
+        assignments = dict(self._assignments)
+        assignments.update(residual._assignments)
+        residual._assignments = assignments
+        return residual
+
+
+class _Specializer(object):
+    """Build the residual program of a _Program given known variables.
+
+    A known variable that the residual program needs to look up, because
+    the program may assign it at runtime, can not be folded anywhere: the
+    residual program would see the value it had when specialization
+    stopped folding it rather than the one it started with. Such variables
+    are recorded in forgotten, and the program must be specialized again
+    without them.
+
+    The residual program is first built as a tree of items, so that the
+    words of expressions are never copied into their parents: strings for
+    known text, lists of items for words spliced into their parents,
+    (_VARIABLE, name, start, end) for variables that are not known and
+    (_EXPRESSION, position, word) for expressions that are evaluated at
+    runtime.
+    """
+
+    def __init__(self, program, known):
+        self.program = program
+        self.empty = program.empty
+        self.known = dict(known)
+        self.forgotten = set()
+        self.assignments = {}
+        # The constants of the residual program.
+        self.constants = []
+
+    def forget(self, name):
+        """Note that the residual program may assign name."""
+        if name in self.known:
+            self.forgotten.add(name)
+
+    def specialize(self):
+        """Return the items of the residual program."""
+        program = self.program
+        names = program.names
+        constants = program.constants
+        code = program.code
+        known = self.known
+        items = []
+        # Whether items has any item that is not known.
+        residual = False
+        # (position, whether its variable was known, parent items, parent
+        # residual) for each _EXPRESSION whose word is being specialized.
+        stack = []
+        # How many of those expressions' variables are not known: while
+        # there are any, whether expressions are evaluated is only known at
+        # runtime, and so are the assignments they make.
+        unknown = 0
+        pc = 0
+        while pc < len(code):
+            op = code[pc]
+            if op == _LITERAL:
+                items.append(constants[code[pc + 1]])
+            elif op == _VARIABLE:
+                name = names[code[pc + 1]]
+                if name in known:
+                    items.append(known[name])
+                else:
+                    items.append(tuple(code[pc:pc + 4]))
+                    residual = True
+            elif op == _EXPRESSION:
+                name = names[code[pc + 1]]
+                operation = code[pc + 3]
+                if unknown and operation == _ASSIGN:
+                    self.forget(name)
+                if name not in known:
+                    unknown += 1
+                    stack.append((pc, False, items, residual))
+                    items, residual = [], False
+                    pc += 7
+                    continue
+                value = known[name]
+                if operation == _ALTERNATIVE:
+                    word = not (not value and code[pc + 2])
+                    if not word:
+                        value = self.empty
+                else:
+                    word = not value and code[pc + 2]
+                if word:
+                    stack.append((pc, True, items, residual))
+                    items, residual = [], False
+                    pc += 7
+                    continue
+                if operation == _ASSIGN:
+                    self.assignments[name] = value
+                    known[name] = value
+                items.append(value)
+                pc = code[pc + 6]
+                continue
+            else:
+                start, static, parent, parent_residual = stack.pop()
+                unknown -= not static
+                word, items = items, parent
+                name = names[code[start + 1]]
+                operation = code[start + 3]
+                if static and operation in (_DEFAULT, _ALTERNATIVE):
+                    items.append(word)
+                    residual = parent_residual or residual
+                elif static and operation == _ASSIGN and not residual:
+                    value = self.empty.join(_flatten(word))
+                    self.assignments[name] = value
+                    known[name] = value
+                    items.append(value)
+                    residual = parent_residual
+                else:
+                    # The variable is assigned at runtime, or an error is
+                    # raised: either way its value is needed at runtime.
+                    self.forget(name)
+                    items.append((_EXPRESSION, start, word))
+                    residual = True
+            pc += _sizes[op]
+        return items
+
+    def assemble(self, items):
+        """Return the _Program for the items of the residual program."""
+        program = self.program
+        names = {}
+        code = []
+        assigns = False
+        # Known text that has not been emitted yet.
+        text = []
+        # An iterator over items, and the position of their _EXPRESSION if
+        # they are its word, for each list of items being emitted.
+        pending = [(iter(items), None)]
+        while pending:
+            for item in pending[-1][0]:
+                if type(item) is list:
+                    pending.append((iter(item), None))
+                    break
+                if type(item) is not tuple:
+                    text.append(item)
+                    continue
+                self.literal(code, text)
+                op = item[0]
+                if op == _VARIABLE:
+                    name = program.names[item[1]]
+                    code.extend((
+                        _VARIABLE, names.setdefault(name, len(names)),
+                        item[2], item[3]))
+                    continue
+                position = item[1]
+                name = program.names[program.code[position + 1]]
+                assigns = assigns or program.code[position + 3] == _ASSIGN
+                pending.append((iter(item[2]), len(code)))
+                code.extend(program.code[position:position + 7])
+                code[-6] = names.setdefault(name, len(names))
+                break
+            else:
+                position = pending.pop()[1]
+                if position is None:
+                    continue
+                self.literal(code, text)
+                code.append(_END)
+                code[position + 6] = len(code)
+        self.literal(code, text)
+        return _Program(
+            program.expression, tuple(sorted(names, key=names.get)),
+            tuple(self.constants), tuple(code), assigns)
+
+    def literal(self, code, text):
+        """Emit a _LITERAL for text, a list of known text, and clear it."""
+        value = self.empty.join(text)
+        if value:
+            code.extend((_LITERAL, len(self.constants)))
+            self.constants.append(value)
+        del text[:]
+
+
+def _flatten(items):
+    """Yield the known text of items, which has no other items."""
+    pending = [iter(items)]
+    while pending:
+        for item in pending[-1]:
+            if type(item) is list:
+                pending.append(iter(item))
+                break
+            yield item
+        else:
+            pending.pop()
+
+
+def _specialize(template, known):
+    """Return the _ResidualTemplate of template given known variables."""
+    # The known variables the residual program looks up.
+    bindings = {}
+    while True:
+        specializer = _Specializer(template._program, dict(
+            item for item in known.items() if item[0] not in bindings))
+        items = specializer.specialize()
+        if not specializer.forgotten:
+            break
+        for name in specializer.forgotten:
+            bindings[name] = known[name]
+    program = specializer.assemble(items)
+    return _ResidualTemplate(
+        template.expression, program, bindings, specializer.assignments)
+
+
+class Resolver(object):
+    """Variables whose values are looked up by calling a function.
+
+    The function is only called for the variables an evaluation actually
+    reaches, and at most once for each variable, so expensive lookups are
+    kept to a minimum. A Resolver can be passed anywhere variables are.
+    """
+
+    def __init__(self, function):
+        """Create a Resolver.
+
+        :param function: Called with a variable name, it returns the value
+            of the variable or raises KeyError if the variable is unset.
+        """
+        self._function = function
+        self._values = {}
+
+    def get(self, name, default=None):
+        try:
+            value = self._values[name]
+        except KeyError:
+            try:
+                value = self._function(name)
+            except KeyError:
+                value = _sentinel
+            self._values[name] = value
+        if value is _sentinel:
+            return default
+        return value
+
+
+Analysis = namedtuple("Analysis", "referenced assigned required")
+
+
+def _analyze(nodes):
+    """Find the variables that nodes use.
+
+    :return: An Analysis.
+    """
+    referenced = set()
+    assigned = set()
+    required = set()
+    pending = list(nodes)
+    while pending:
+        node = pending.pop()
+        if type(node) == _Literal:
+            continue
+        referenced.add(node.name)
+        if type(node) == _Expression:
+            if node.op == '=':
+                assigned.add(node.name)
+            elif node.op == '?':
+                required.add(node.name)
+            pending.extend(node.word)
+    return Analysis(
+        frozenset(referenced), frozenset(assigned), frozenset(required))
+
+
+class _GeneratedTemplate(Template):
+    """A Template evaluated by Python code generated for its expression.
+
+    A function is generated and compiled for each value of absent the first
+    time the template is evaluated with it. Expressions nested too deeply to
+    generate code for are evaluated like a normal Template.
+    """
+
+    __slots__ = ('_functions',)
+
+    def __init__(self, expression, nodes):
+        super(_GeneratedTemplate, self).__init__(expression, nodes)
+        self._functions = {}
+
+    def __repr__(self):
+        return 'Template(%r, CODEGEN)' % (self.expression,)
+
+    def _function(self, absent, counted=False):
+        key = (absent, counted)
+        function = self._functions.get(key)
+        if function is None:
+            function = _generate(
+                self.nodes, absent, self.analysis.assigned, counted,
+                self.expression[:0])
+            self._functions[key] = function
+        return function
+
+    def evaluate(self, variables, absent=EMPTY):
+        _check_absent(absent)
+        if _instrumentation is not None:
+            return _instrumentation._evaluate(self, variables, absent)
+        function = self._function(absent)
+        if function is None:
+            return Template.evaluate(self, variables, absent)
+        return function(variables)
+
+    def _evaluate_counted(self, variables, absent, stats):
+        function = self._function(absent, True)
+        if function is None:
+            return Template._evaluate_counted(self, variables, absent, stats)
+        return function(variables, stats)
+
+    def _evaluate_many(self, variable_sets, absent):
+        function = self._function(absent)
+        if function is None or _instrumentation is not None:
+            for result in Template._evaluate_many(self, variable_sets, absent):
+                yield result
+            return
+        for variables in variable_sets:
+            yield function(variables)
+
+
+# Generated code nests one or two blocks per level of nested expressions, and
+# Python limits how deeply blocks can be nested.
+_max_generated_depth = 32
+
+
+def _generate(nodes, absent, assigned, counted=False, empty=''):
+    """Generate a function that evaluates nodes.
+
+    :param assigned: The variables that nodes may assign.
+    :param counted: If True, the function takes a second argument, a dict
+        in which it counts the nodes it visits like _evaluate.
+    :param empty: '' or b'', as nodes were parsed from str or bytes.
+    :return: A function that takes the variables and returns the same
+        (string, dict) result as _evaluate, or None if nodes are nested too
+        deeply to generate code for.
+    """
+    if _depth(nodes) > _max_generated_depth:
+        return None
+    generator = _Generator(absent, assigned, counted, empty)
+    result = generator.sequence(nodes, 1)
+    if counted:
+        lines = ['def evaluate(variables, stats):']
+    else:
+        lines = ['def evaluate(variables):']
+    lines.append('    get = variables.get')
+    if assigned:
+        lines.append('    assigned = {}')
+    lines.extend(generator.lines)
+    lines.append('    return %s, %s' % (result, 'assigned' if assigned else '{}'))
+    namespace = {
+        '_s': _sentinel, 'EvaluationError': EvaluationError,
+        '_message': _message}
+    code = _builtin_compile(
+        '\n'.join(lines) + '\n', '<shellvars template>', 'exec')
+    exec(code, namespace)
+    return namespace['evaluate']
+
+
+def _depth(nodes):
+    """Return how deeply nodes nest expressions."""
+    depth = 0
+    pending = [(nodes, 0)]
+    while pending:
+        nodes, level = pending.pop()
+        depth = max(depth, level)
+        for node in nodes:
+            if type(node) == _Expression:
+                pending.append((node.word, level + 1))
+    return depth
+
+
+class _Generator(object):
+    """Generate the statements of a function that evaluates nodes.
+
+    Every value is computed into a fresh local variable, so the generated
+    code is straight-line except for the branches of '-', '=', '?' and '+'
+    expressions.
+    """
+
+    def __init__(self, absent, assigned, counted, empty):
+        self.absent = absent
+        self.assigned = assigned
+        self.counted = counted
+        self.empty = empty
+        self.lines = []
+        self.locals = 0
+
+    def emit(self, indent, line):
+        self.lines.append('    ' * indent + line)
+
+    def local(self):
+        self.locals += 1
+        return 'v%d' % self.locals
+
+    def sequence(self, nodes, indent):
+        """Emit code for nodes and return an expression for their value."""
+        values = [self.node(node, indent) for node in nodes]
+        if not values:
+            return repr(self.empty)
+        if len(values) == 1:
+            return values[0]
+        return '%r.join((%s,))' % (self.empty, ', '.join(values))
+
+    def lookup(self, name, default, indent):
+        value = self.local()
+        if name in self.assigned:
+            self.emit(indent, '%s = assigned.get(%r, _s)' % (value, name))
+            self.emit(indent, 'if %s is _s:' % (value,))
+            self.emit(indent + 1, '%s = get(%r, %s)' % (value, name, default))
+        else:
+            self.emit(indent, '%s = get(%r, %s)' % (value, name, default))
+        return value
+
+    def word(self, node, value, indent):
+        self.emit(indent, '%s = %s' % (value, self.sequence(node.word, indent)))
+
+    def node(self, node, indent):
+        if type(node) == _Literal:
+            return repr(node.value)
+        if self.counted:
+            op = '$' if type(node) == _SimpleExpression else node.op
+            self.emit(indent, 'stats[%r] += 1' % (op,))
+        if type(node) == _SimpleExpression:
+            if self.absent is EMPTY:
+                return self.lookup(node.name, repr(self.empty), indent)
+            value = self.lookup(node.name, '_s', indent)
+            self.emit(indent, 'if %s is _s:' % (value,))
+            self.emit(indent + 1, '%s = %r' % (value, node.text))
+            return value
+        value = self.lookup(node.name, '_s', indent)
+        if self.absent is SKIP:
+            self.emit(indent, 'if %s is _s:' % (value,))
+            self.emit(indent + 1, '%s = %r' % (value, _source(node)))
+            self.emit(indent, 'else:')
+            self.operation(node, value, None, indent + 1)
+        else:
+            self.operation(node, value, '%s is _s' % (value,), indent)
+        return value
+
+    def operation(self, node, value, unset, indent):
+        """Emit the code for the operation of node.
+
+        :param value: The local holding the value of the variable.
+        :param unset: A condition that is true if the variable is unset, or
+            None if it is known to be set.
+        """
+        null = '%s is _s or not %s' % (value, value) if unset else (
+            'not %s' % (value,))
+        if node.op == '+':
+            condition = null if node.null is not None else unset
+            if condition is None:
+                self.word(node, value, indent)
+                return
+            self.emit(indent, 'if %s:' % (condition,))
+            self.emit(indent + 1, '%s = %r' % (value, self.empty))
+            self.emit(indent, 'else:')
+            self.word(node, value, indent + 1)
+            return
+        if node.null is not None:
+            self.emit(indent, 'if %s:' % (null,))
+            self.taken(node, value, indent + 1)
+        else:
+            if unset is not None:
+                self.emit(indent, 'if %s:' % (unset,))
+                self.taken(node, value, indent + 1)
+                self.emit(indent, 'elif not %s:' % (value,))
+            else:
+                self.emit(indent, 'if not %s:' % (value,))
+            self.emit(indent + 1, '%s = %r' % (value, self.empty))
+        if node.op == '=':
+            self.emit(indent, 'assigned[%r] = %s' % (node.name, value))
+
+    def taken(self, node, value, indent):
+        """Emit the code for when the variable is unset or null."""
+        if node.op == '?':
+            message = "Variable '%s' null or unset." % (_message(node.name),)
+            self.word(node, value, indent)
+            self.emit(indent, 'raise EvaluationError(_message(%s) or %r)' % (
+                value, message))
+        else:
+            self.word(node, value, indent)
+
+
+try:
+    _clock = time.perf_counter
+except AttributeError:
+    _clock = time.time
+
+
+class _CountingVariables(object):
+    """Variables that count how often they are looked up."""
+
+    __slots__ = ('variables', 'lookups')
+
+    def __init__(self, variables):
+        self.variables = variables
+        self.lookups = 0
+
+    def get(self, name, default=None):
+        self.lookups += 1
+        return self.variables.get(name, default)
+
+    def __setitem__(self, name, value):
+        self.variables[name] = value
+
+
+class _Chunk(object):
+    """Text evaluated by evaluate_stream, as a Template for Instrumentation.
+
+    Unlike a Template, it assigns variables in the variables it is given, so
+    that they are seen by the rest of the stream.
+    """
+
+    __slots__ = ('expression', '_program')
+
+    def __init__(self, expression, program):
+        self.expression = expression
+        self._program = program
+
+    def _evaluate_counted(self, variables, absent, stats):
+        return _evaluate(self._program, variables, absent, stats)
+
+
+class Instrumentation(object):
+    """Statistics about parsing and evaluating expressions.
+
+    Instrumentation is off by default and costs nothing until it is turned
+    on by passing an Instrumentation to ``instrument``. From then on every
+    parse and every evaluation of a Template (including by ``evaluate``) is
+    recorded, as is each chunk of text ``evaluate_stream`` parses and
+    evaluates.
+
+    The statistics are available from ``snapshot``, and each parse and
+    evaluation is also passed to the hook given to the constructor, if any,
+    so that they can be forwarded elsewhere.
+    """
+
+    def __init__(self, hook=None):
+        """Create an Instrumentation.
+
+        :param hook: If not None, called as hook(event, data) after each
+            parse and evaluation. event is 'parse' or 'evaluate', and data is
+            a dict: for a parse, {'seconds', 'input_size'}; for an
+            evaluation, {'seconds', 'input_size', 'output_size', 'lookups',
+            'nodes', 'error'}, where nodes maps each kind of node ('$' for
+            $NAME and ${NAME}, or the operator '-', '=', '?' or '+') to how
+            many were visited, and error is True if the evaluation raised an
+            exception such as EvaluationError.
+        """
+        self.hook = hook
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Set all the statistics to zero."""
+        with self._lock:
+            self._stats = {
+                'parses': 0,
+                'parse_seconds': 0.0,
+                'parse_input_size': 0,
+                'evaluations': 0,
+                'evaluate_seconds': 0.0,
+                'evaluate_input_size': 0,
+                'evaluate_output_size': 0,
+                'lookups': 0,
+                'errors': 0,
+                'nodes': dict.fromkeys(_node_kinds, 0),
+                }
+
+    def snapshot(self):
+        """Return a copy of the statistics recorded so far, as a dict.
+
+        The keys are 'parses', 'parse_seconds' and 'parse_input_size' for
+        parsing, and 'evaluations', 'evaluate_seconds',
+        'evaluate_input_size', 'evaluate_output_size', 'lookups', 'errors'
+        and 'nodes' for evaluation, as for the data passed to the hook.
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats['nodes'] = dict(stats['nodes'])
+        return stats
+
+    def _scan(self, expression, final=True):
+        start = _clock()
+        nodes = _scan(expression, final)
+        seconds = _clock() - start
+        with self._lock:
+            self._stats['parses'] += 1
+            self._stats['parse_seconds'] += seconds
+            self._stats['parse_input_size'] += len(expression)
+        if self.hook is not None:
+            self.hook('parse', {
+                'seconds': seconds, 'input_size': len(expression)})
+        return nodes
+
+    def _evaluate(self, template, variables, absent):
+        counter = _CountingVariables(variables)
+        nodes = dict.fromkeys(_node_kinds, 0)
+        error = True
+        output_size = 0
+        start = _clock()
+        try:
+            result = template._evaluate_counted(counter, absent, nodes)
+            error = False
+            output_size = len(result[0])
+        finally:
+            seconds = _clock() - start
+            stats = self._stats
+            with self._lock:
+                stats['evaluations'] += 1
+                stats['evaluate_seconds'] += seconds
+                stats['evaluate_input_size'] += len(template.expression)
+                stats['evaluate_output_size'] += output_size
+                stats['lookups'] += counter.lookups
+                stats['errors'] += error
+                for kind, count in nodes.items():
+                    stats['nodes'][kind] += count
+            if self.hook is not None:
+                self.hook('evaluate', {
+                    'seconds': seconds,
+                    'input_size': len(template.expression),
+                    'output_size': output_size,
+                    'lookups': counter.lookups,
+                    'nodes': nodes,
+                    'error': error,
+                    })
+        return result
+
+
+_node_kinds = ('$',) + tuple(_ops)
+_instrumentation = None
+
+
+def instrument(instrumentation):
+    """Record statistics about parsing and evaluation.
+
+    :param instrumentation: An Instrumentation to record the statistics in,
+        or None to stop recording them.
+    :return: The Instrumentation that was recording statistics before, or
+        None.
+    """
+    global _instrumentation
+    previous = _instrumentation
+    _instrumentation = instrumentation
+    return previous
+
+
+CacheInfo = namedtuple("CacheInfo", "hits misses evictions maxsize currsize")
+
+
+class _ClockCache(object):
+    """A bounded mapping that discards entries that have not been used
+    recently.
+
+    Entries are evicted with the CLOCK algorithm: they sit in a ring, each
+    with a flag set whenever it is looked up, and a hand sweeps the ring
+    when room is needed, clearing flags until it finds an entry whose flag
+    is already clear. This approximates least-recently-used eviction, but a
+    lookup only reads the dict of entries and sets a flag, so lookups take
+    no lock and any number of threads can look up entries in parallel.
+    Adding, evicting and resizing take a lock.
+
+    Hits and misses are counted separately for each thread, so counting
+    does not make threads contend either.
+    """
+
+    def __init__(self, maxsize):
+        self._lock = threading.Lock()
+        # key -> [key, value, used]
+        self._entries = {}
+        self._ring = []
+        self._hand = 0
+        self.maxsize = maxsize
+        self.evictions = 0
+        self._local = threading.local()
+        # (thread, [hits, misses]) for each thread that has used the cache,
+        # and the counts of threads that have since finished.
+        self._counts = []
+        self._finished = [0, 0]
+
+    def _thread_counts(self):
+        try:
+            return self._local.counts
+        except AttributeError:
+            counts = self._local.counts = [0, 0]
+            with self._lock:
+                self._retire()
+                self._counts.append((threading.current_thread(), counts))
+            return counts
+
+    def _retire(self):
+        """Fold the counts of finished threads into _finished."""
+        running = []
+        for thread, counts in self._counts:
+            if thread.is_alive():
+                running.append((thread, counts))
+            else:
+                self._finished[0] += counts[0]
+                self._finished[1] += counts[1]
+        self._counts = running
+
+    def get(self, key, default=None):
+        entry = self._entries.get(key)
+        if entry is None:
+            self._thread_counts()[1] += 1
+            return default
+        entry[2] = True
+        self._thread_counts()[0] += 1
+        return entry[1]
+
+    def set(self, key, value):
+        """Add value for key, unless another thread already has.
+
+        :return: The value now cached for key, or value if the cache is
+            disabled.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                return entry[1]
+            if self.maxsize <= 0:
+                return value
+            entry = [key, value, False]
+            if len(self._ring) < self.maxsize:
+                self._ring.append(entry)
+            else:
+                self._ring[self._sweep()] = entry
+                self._hand = (self._hand + 1) % len(self._ring)
+            self._entries[key] = entry
+            return value
+
+    def _sweep(self):
+        """Evict the next entry that has not been used, returning its
+        position in the ring."""
+        ring = self._ring
+        while ring[self._hand][2]:
+            ring[self._hand][2] = False
+            self._hand = (self._hand + 1) % len(ring)
+        del self._entries[ring[self._hand][0]]
+        self.evictions += 1
+        return self._hand
+
+    def resize(self, maxsize):
+        if maxsize < 0:
+            raise ValueError("invalid cache size %r" % (maxsize,))
+        with self._lock:
+            self.maxsize = maxsize
+            while len(self._ring) > maxsize:
+                del self._ring[self._sweep()]
+                if self._hand >= len(self._ring):
+                    self._hand = 0
+
+    def clear(self):
+        with self._lock:
+            # Replaced rather than cleared, as lookups may be reading it.
+            self._entries = {}
+            self._ring = []
+            self._hand = 0
+            self.evictions = 0
+            self._retire()
+            self._finished = [0, 0]
+            for _, counts in self._counts:
+                counts[0] = counts[1] = 0
+
+    def info(self):
+        with self._lock:
+            self._retire()
+            hits, misses = self._finished
+            for _, counts in self._counts:
+                hits += counts[0]
+                misses += counts[1]
+            return CacheInfo(
+                hits, misses, self.evictions, self.maxsize, len(self._ring))
+
+
+_cache = _ClockCache(2048)
+
+
+def cache_info():
+    """Return statistics about the cache of parsed expressions.
+
+    :return: A CacheInfo tuple (hits, misses, evictions, maxsize, currsize).
+    """
+    return _cache.info()
+
+
+def cache_clear():
+    """Discard all parsed expressions and reset the cache statistics."""
+    _cache.clear()
+
+
+def set_cache_size(maxsize):
+    """Set the number of parsed expressions that are cached.
+
+    Least recently used expressions are discarded if the cache currently
+    holds more than maxsize expressions. A maxsize of 0 disables caching.
+    """
+    _cache.resize(maxsize)
+
+
+class ResultCache(object):
+    """Cache the results of evaluating a Template.
+
+    The result of evaluating a template only depends on the variables it
+    references, so results are cached by the values of just those variables:
+    looking up a result takes time proportional to the number of variables
+    the template references, however many variables are passed in. A
+    variable that is only tested by ${NAME+WORD} or ${NAME:+WORD} only
+    contributes whether it is unset, null or set to the key, as its value
+    cannot change the result.
+
+    Evaluations that raise EvaluationError are cached too, and raise a new
+    EvaluationError with the same message when repeated.
+    """
+
+    def __init__(self, template, maxsize=1024):
+        """Create a ResultCache.
+
+        :param template: The Template to evaluate.
+        :param maxsize: The number of results to keep. Results that have
+            not been used recently are discarded first.
+        """
+        self.template = template
+        self._cache = _ClockCache(maxsize)
+        self._values, self._states = _key_names(template.nodes)
+
+    def evaluate(self, variables, absent=EMPTY):
+        """Evaluate the template with variables, reusing cached results.
+
+        See ``evaluate`` for the meaning of the parameters and the result.
+        """
+        _check_absent(absent)
+        key = [absent]
+        for name in self._values:
+            key.append(variables.get(name, _sentinel))
+        for name in self._states:
+            value = variables.get(name, _sentinel)
+            key.append(0 if value is _sentinel else 2 if value else 1)
+        key = tuple(key)
+        try:
+            result = self._cache.get(key)
+        except TypeError:
+            # An unhashable value.
+            return self.template.evaluate(variables, absent)
+        if result is None:
+            try:
+                result = self.template.evaluate(variables, absent)
+            except EvaluationError as error:
+                result = error
+            result = self._cache.set(key, result)
+        if isinstance(result, EvaluationError):
+            raise EvaluationError(*result.args)
+        return result[0], dict(result[1])
+
+    def info(self):
+        """Return a CacheInfo with statistics about the cached results."""
+        return self._cache.info()
+
+    def clear(self):
+        """Discard all cached results and reset the statistics."""
+        self._cache.clear()
+
+
+def _key_names(nodes):
+    """Find the variables whose values a ResultCache must key on.
+
+    :return: A tuple (values, states) of sorted lists of variable names.
+        states holds the variables only tested by '+' expressions, for which
+        whether they are unset, null or set is enough. values holds the rest.
+    """
+    values = set()
+    tested = set()
+    pending = list(nodes)
+    while pending:
+        node = pending.pop()
+        if type(node) == _Literal:
+            continue
+        if type(node) == _Expression:
+            pending.extend(node.word)
+            if node.op == '+':
+                tested.add(node.name)
+                continue
+        values.add(node.name)
+    return sorted(values), sorted(tested - values)
+
+
+def compile(expression, backend=INTERPRET):
+    """Parse expression into a reusable Template.
+
+    Parsed expressions are kept in a bounded cache (see ``cache_info``), so
+    compiling a recently seen expression is cheap. Looking an expression up
+    in the cache takes no lock, and Templates share no mutable state between
+    evaluations, so any number of threads can compile and evaluate
+    expressions at once.
+
+    :param expression: A shell expression to parse, as str or bytes. A
+        memoryview or bytearray is copied to bytes.
+    :param backend: If INTERPRET then the Template evaluates the parsed
+        expression directly. If CODEGEN then Python code specialised for the
+        expression is generated and compiled, which is slower to set up but
+        faster to evaluate.
+    :return: A Template whose evaluate method evaluates expression.
+    """
+    if isinstance(expression, (memoryview, bytearray)):
+        expression = bytes(expression)
+    if backend is INTERPRET:
+        key = expression
+        factory = Template
+    elif backend is CODEGEN:
+        key = (backend, expression)
+        factory = _GeneratedTemplate
+    else:
+        raise ValueError("invalid value for backend %r" % (backend,))
+    template = _cache.get(key)
+    if template is None:
+        if _instrumentation is None:
+            nodes = _scan(expression)
+        else:
+            nodes = _instrumentation._scan(expression)
+        # If another thread compiled expression meanwhile, use its Template
+        # so that compiling an expression always gives the same one.
+        template = _cache.set(key, factory(expression, nodes))
+    return template
+
+
 def evaluate(expression, variables, absent=EMPTY):
     """Evaluate expression with variables.
 
     :param expression: A shell expression to evaluate.
-    :param variables: The variables available to the expression.
+    :param variables: A mapping of the variables available to the
+        expression. It is neither copied nor modified, and only the variables
+        the evaluation needs are looked up in it.
     :param absent: If EMPTY then variables that are not present in variables
         are treated as having the value ''. If SKIP then such variables are
         not evaluated at all.
@@ -77,100 +1610,259 @@ def evaluate(expression, variables, absent=EMPTY):
         evaluating the expression, and the dict contains any variable
         assignments performed by the expression.
     """
-    if absent not in (EMPTY, SKIP):
-        raise ValueError("invalid value for absent %r" % (absent,))
-    variables = dict(variables)
-    g = _grammar(expression)
-    return _evaluate(g.string(), variables, absent)
+    _check_absent(absent)
+    return compile(expression).evaluate(variables, absent)
+
+def evaluate_many(expression, variable_sets, absent=EMPTY):
+    """Evaluate expression with each of several sets of variables.
+
+    The expression is only parsed once. See ``Template.evaluate_many``.
+    """
+    _check_absent(absent)
+    return compile(expression).evaluate_many(variable_sets, absent)
+
+
+def evaluate_columns(expression, columns, absent=EMPTY):
+    """Evaluate expression once for each row of a table of variables.
+
+    The expression is only parsed once. See ``Template.evaluate_columns``.
+    """
+    _check_absent(absent)
+    return compile(expression).evaluate_columns(columns, absent)
+
+def analyze(expression):
+    """Find the variables that expression uses, without evaluating it.
+
+    :param expression: A shell expression to analyze.
+    :return: An Analysis tuple (referenced, assigned, required) of frozensets
+        of variable names. referenced holds every variable the expression
+        may look up, assigned the variables it may assign with ${NAME=WORD}
+        or ${NAME:=WORD}, and required the variables it may reject as unset
+        or null with ${NAME?WORD} or ${NAME:?WORD}. Which of them are
+        actually used depends on the values of the variables.
+    """
+    return compile(expression).analysis
+
+def evaluate_stream(reader, writer, variables, absent=EMPTY,
+                    chunk_size=65536):
+    """Evaluate the text read from reader, writing the result to writer.
+
+    The text is read and evaluated in chunks, so memory use is bounded by the
+    chunk size and the longest expression in the text rather than by the
+    size of the text. Expressions that span chunks are evaluated as a whole.
 
-def _evaluate(nodes, variables, absent):
+    :param reader: A file-like object whose read method is called with
+        chunk_size until it returns an empty string. It may return str or
+        bytes.
+    :param writer: A file-like object whose write method is called with the
+        evaluated text, of the same type as the text read.
+    :param variables: As for ``evaluate``.
+    :param absent: As for ``evaluate``.
+    :param chunk_size: The amount of text to read at a time, at least 1.
+    :return: A dict of the variable assignments performed by the text.
+    """
+    _check_absent(absent)
+    if chunk_size < 1:
+        raise ValueError("invalid chunk size %r" % (chunk_size,))
+    variables = _Overlay(variables)
+    assignments = {}
+    chunk = reader.read(chunk_size)
+    # '' or b'', as the reader returns str or bytes.
+    empty = chunk[:0]
+    pending = empty
+    # Text read since pending was last scanned.
+    chunks = []
+    unscanned = 0
+    while chunk:
+        chunks.append(chunk)
+        unscanned += len(chunk)
+        # Rescanning an expression that spans many chunks as each chunk is
+        # read would take quadratic time: wait until the text read is as
+        # long as the text pending.
+        if unscanned >= len(pending):
+            text = pending + empty.join(chunks)
+            del chunks[:]
+            unscanned = 0
+            if _instrumentation is None:
+                nodes, end = _scan(text, final=False)
+            else:
+                nodes, end = _instrumentation._scan(text, final=False)
+            pending = text[end:]
+            if nodes:
+                output, assigned = _evaluate_chunk(
+                    text, end, nodes, variables, absent)
+                assignments.update(assigned)
+                writer.write(output)
+        chunk = reader.read(chunk_size)
+    pending += empty.join(chunks)
+    if pending:
+        if _instrumentation is None:
+            nodes = _scan(pending)
+        else:
+            nodes = _instrumentation._scan(pending)
+        output, assigned = _evaluate_chunk(
+            pending, len(pending), nodes, variables, absent)
+        assignments.update(assigned)
+        writer.write(output)
+    return assignments
+
+
+def _evaluate_chunk(text, end, nodes, variables, absent):
+    """Evaluate nodes, parsed from text[:end], for evaluate_stream."""
+    program = _assemble(text, nodes)
+    if _instrumentation is None:
+        return _evaluate(program, variables, absent)
+    return _instrumentation._evaluate(
+        _Chunk(text[:end], program), variables, absent)
+
+def evaluate_async(expression, resolver, absent=EMPTY):
+    """Evaluate expression with variables looked up by a coroutine function.
+
+    The variables are fetched before expression is evaluated, those of each
+    word that is evaluated concurrently: first the variables of the top
+    level of expression, then, once their values show which words are
+    evaluated, the variables of the top level of those words, and so on.
+    Where which words are evaluated depends on a value assigned by the
+    expression, variables are fetched one at a time as evaluation reaches
+    them.
+
+    :param expression: A shell expression to evaluate.
+    :param resolver: A coroutine function called with a variable name, that
+        returns the value of the variable or raises KeyError if the variable
+        is unset. It is called at most once for each variable.
+    :param absent: As for ``evaluate``.
+    :return: An awaitable of the same (string, dict) tuple ``evaluate``
+        returns.
+    """
+    from shellvars._aio import evaluate_async
+    return evaluate_async(expression, resolver, absent)
+
+def _evaluate(program, variables, absent, stats=None):
+    """Evaluate program with variables.
+
+    Evaluation does not recurse into the words of expressions: for each
+    expression whose word is being evaluated, the position of its
+    instruction and the length of the output before its word are kept on an
+    explicit stack, so expressions can be nested arbitrarily deeply. All
+    assignments are collected in a single dict.
+
+    :param program: A _Program.
+    :param variables: An object with a get method like dict.get, which must
+        support item assignment if program assigns variables. If the
+        expression of program is bytes, so must the names and values of the
+        variables be.
+    :param stats: If not None, a dict in which to count the nodes visited of
+        each kind, as described by Instrumentation.
+    :return: A tuple (string, dict) as described by evaluate.
+    """
+    expression = program.expression
+    empty = program.empty
+    names = program.names
+    constants = program.constants
+    code = program.code
+    skip = absent is SKIP
     output = []
     assignments = {}
-    for node in nodes:
-        unset = False
-        if type(node) == _Literal:
-            output.append(node.value)
-        elif type(node) == _SimpleExpression:
-            value = variables.get(node.name, _sentinel)
+    stack = []
+    pc = 0
+    end = len(code)
+    while pc < end:
+        op = code[pc]
+        if op == _LITERAL:
+            output.append(constants[code[pc + 1]])
+            pc += 2
+        elif op == _VARIABLE:
+            if stats is not None:
+                stats['$'] += 1
+            value = variables.get(names[code[pc + 1]], _sentinel)
             if value is _sentinel:
-                if absent is SKIP:
-                    output.append(node.text)
-                    continue
+                if skip:
+                    value = expression[code[pc + 2]:code[pc + 3]]
                 else:
-                    value = ''
+                    value = empty
             output.append(value)
-        elif type(node) == _Expression:
-            if node.op == '-':
-                # Default
-                value = variables.get(node.name, _sentinel)
-                if value is _sentinel:
-                    if absent is SKIP:
-                        output.append(node.text)
-                        continue
-                    else:
-                        unset = True
-                if unset or not value:
-                    if unset or node.null is not None:
-                        value, _assign = _evaluate(node.word, variables, absent)
-                        assignments.update(_assign)
-                    else:
-                        value = ''
-                output.append(value)
-            elif node.op == '=':
-                # Assignment
-                value = variables.get(node.name, _sentinel)
-                if value is _sentinel:
-                    if absent is SKIP:
-                        output.append(node.text)
-                        continue
-                    else:
-                        unset = True
-                if unset or not value:
-                    if unset or node.null is not None:
-                        value, _assign = _evaluate(node.word, variables, absent)
-                        assignments.update(_assign)
-                    else:
-                        value = ''
-                output.append(value)
-                assignments[node.name] = value
-                variables[node.name] = value
-            elif node.op == '?':
-                # Error
-                value = variables.get(node.name, _sentinel)
-                if value is _sentinel:
-                    if absent is SKIP:
-                        output.append(node.text)
-                        continue
-                    else:
-                        unset = True
-                if unset or not value:
-                    if unset or node.null is not None:
-                        value, _ = _evaluate(node.word, variables, absent)
-                        if value:
-                            raise EvaluationError(value)
-                        else:
-                            raise EvaluationError(
-                                "Variable '%s' null or unset." % (node.name,))
-                    else:
-                        value = ''
-                output.append(value)
-            elif node.op == '+':
-                # Alternative value
-                value = variables.get(node.name, _sentinel)
-                if value is _sentinel:
-                    if absent is SKIP:
-                        output.append(node.text)
-                        continue
-                    else:
-                        unset = True
-                if unset or not value and node.null:
-                    value = ''
-                else:
-                        value, _assign = _evaluate(node.word, variables, absent)
-                        assignments.update(_assign)
-                output.append(value)
+            pc += 4
+        elif op == _EXPRESSION:
+            operation = code[pc + 3]
+            if stats is not None:
+                stats[_ops[operation]] += 1
+            name = names[code[pc + 1]]
+            value = variables.get(name, _sentinel)
+            unset = value is _sentinel
+            if unset and skip:
+                output.append(expression[code[pc + 4]:code[pc + 5]])
+                pc = code[pc + 6]
+                continue
+            if operation == _ALTERNATIVE:
+                word = not (unset or not value and code[pc + 2])
+                if not word:
+                    value = empty
             else:
-                raise Exception("Unhandled operation")
+                # Default, assignment and error
+                word = unset or not value and code[pc + 2]
+                if not word and not value:
+                    value = empty
+            if word:
+                stack.append(pc)
+                stack.append(len(output))
+                pc += 7
+                continue
+            if operation == _ASSIGN:
+                assignments[name] = value
+                variables[name] = value
+            output.append(value)
+            pc = code[pc + 6]
         else:
-            raise Exception('Unknown node type')
-    return ''.join(output), assignments
+            # The word of the innermost expression has been evaluated.
+            mark = stack.pop()
+            start = stack.pop()
+            value = empty.join(output[mark:])
+            del output[mark:]
+            operation = code[start + 3]
+            if operation == _ERROR:
+                if value:
+                    raise EvaluationError(_message(value))
+                raise EvaluationError("Variable '%s' null or unset." % (
+                    _message(names[code[start + 1]]),))
+            if operation == _ASSIGN:
+                name = names[code[start + 1]]
+                assignments[name] = value
+                variables[name] = value
+            output.append(value)
+            pc += 1
+    return empty.join(output), assignments
+
+
+# The names re-exported from submodules, which are only imported when one
+# of their names is first used, so that importing shellvars stays cheap.
+_submodules = {
+    'BulkResult': 'shellvars.bulk',
+    'evaluate_bulk': 'shellvars.bulk',
+    'evaluate_files': 'shellvars.bulk',
+    'Catalogue': 'shellvars.catalogue',
+    'CatalogueError': 'shellvars.catalogue',
+    'load_catalogue': 'shellvars.catalogue',
+    'save_catalogue': 'shellvars.catalogue',
+    'CycleError': 'shellvars.environment',
+    'Environment': 'shellvars.environment',
+    }
+
+
+def __getattr__(name):
+    try:
+        module = _submodules[name]
+    except KeyError:
+        raise AttributeError(
+            "module 'shellvars' has no attribute %r" % (name,))
+    import importlib
+    value = getattr(importlib.import_module(module), name)
+    globals()[name] = value
+    return value
+
+
+if sys.version_info < (3, 7):
+    # Module __getattr__ is not supported, so import them now.
+    from shellvars.bulk import BulkResult, evaluate_bulk, evaluate_files
+    from shellvars.catalogue import (
+        Catalogue, CatalogueError, load_catalogue, save_catalogue)
+    from shellvars.environment import CycleError, Environment
@@ -0,0 +1,149 @@
+# Copyright (c) 2015 Robert Collins <robertc@robertcollins.net>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Evaluate expressions with variables looked up by coroutines.
+
+This is a separate module because it uses syntax that needs Python 3.5.
+"""
+
+import asyncio
+
+from shellvars import (
+    EMPTY,
+    SKIP,
+    _Expression,
+    _Literal,
+    _analyze,
+    _check_absent,
+    _sentinel,
+    compile,
+    )
+
+
+class _Missing(Exception):
+    """A variable that has not been fetched yet was looked up."""
+
+    def __init__(self, name):
+        super(_Missing, self).__init__(name)
+        self.name = name
+
+
+class _Fetched(object):
+    """Variables that have been fetched already."""
+
+    __slots__ = ('values',)
+
+    def __init__(self, values):
+        self.values = values
+
+    def get(self, name, default=None):
+        try:
+            value = self.values[name]
+        except KeyError:
+            raise _Missing(name)
+        if value is _sentinel:
+            return default
+        return value
+
+
+async def _fetch(resolver, name):
+    try:
+        return await resolver(name)
+    except KeyError:
+        return _sentinel
+
+
+async def _fetch_word(nodes, values, assigned, resolver):
+    """Fetch the variables the top level of a word looks up, concurrently."""
+    names = sorted(set(
+        node.name for node in nodes
+        if type(node) != _Literal and node.name not in values
+        and node.name not in assigned))
+    fetched = await asyncio.gather(*[_fetch(resolver, name) for name in names])
+    values.update(zip(names, fetched))
+
+
+def _taken(node, value, skip):
+    """Return whether evaluating node evaluates its word.
+
+    :param value: The value of the variable of node, or _sentinel if unset.
+    """
+    unset = value is _sentinel
+    if unset and skip:
+        return False
+    if node.op == '+':
+        return not (unset or node.null and not value)
+    return bool(unset or node.null and not value)
+
+
+async def _prefetch(nodes, values, resolver, skip):
+    """Fetch the variables that evaluating nodes looks up.
+
+    Evaluating a word looks up the variable of every node at its top level,
+    so they are fetched together as soon as it is known that the word is
+    evaluated. Once the variable of an expression is known, so is whether
+    its word is evaluated. The words of expressions whose variable may have
+    been assigned by then are not examined: their variables are fetched when
+    evaluation reaches them.
+    """
+    # Variables that may have been assigned, so their value is not known.
+    assigned = set()
+    # The words being examined that contain the current one, as (nodes,
+    # position of the next node, expression whose word nodes is).
+    stack = []
+    word, position, owner = nodes, 0, None
+    await _fetch_word(word, values, assigned, resolver)
+    while True:
+        if position == len(word):
+            if owner is None:
+                return
+            if owner.op == '?':
+                # Evaluation stops with an EvaluationError here.
+                return
+            if owner.op == '=':
+                assigned.add(owner.name)
+            word, position, owner = stack.pop()
+            continue
+        node = word[position]
+        position += 1
+        if type(node) != _Expression:
+            continue
+        if node.name in assigned:
+            assigned.update(_analyze([node]).assigned)
+        elif _taken(node, values[node.name], skip):
+            stack.append((word, position, owner))
+            word, position, owner = node.word, 0, node
+            await _fetch_word(word, values, assigned, resolver)
+
+
+async def evaluate_async(expression, resolver, absent=EMPTY):
+    _check_absent(absent)
+    template = compile(expression)
+    values = {}
+    await _prefetch(template.nodes, values, resolver, absent is SKIP)
+    variables = _Fetched(values)
+    while True:
+        try:
+            return template.evaluate(variables, absent)
+        except _Missing as missing:
+            # A variable _prefetch could not tell would be looked up.
+            # Evaluate again once it has been fetched: as evaluation does
+            # not depend on anything else, it reaches the same point again.
+            values[missing.name] = await _fetch(resolver, missing.name)
@@ -0,0 +1,203 @@
+# Copyright (c) 2015 Robert Collins <robertc@robertcollins.net>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Evaluate many expressions or files in parallel worker processes."""
+
+__all__ = ['BulkResult', 'evaluate_bulk', 'evaluate_files', 'main']
+
+from collections import namedtuple
+import functools
+import io
+import os
+import sys
+
+from shellvars import EMPTY, SKIP, _check_absent, evaluate
+
+
+class BulkResult(namedtuple("BulkResult", "value assignments error")):
+    """The result of evaluating one expression or file.
+
+    If evaluating it failed, value and assignments are None and error is the
+    exception raised. Otherwise error is None.
+    """
+
+    __slots__ = ()
+
+
+# The variables and absent mode of a worker process, set once by
+# _initialize. Evaluating in this process does not use them, so that
+# several evaluate_bulk iterators can be consumed together.
+_worker = {}
+
+
+def _initialize(variables, absent):
+    _worker['variables'] = variables
+    _worker['absent'] = absent
+
+
+def _in_worker(function, item):
+    return function(item, _worker['variables'], _worker['absent'])
+
+
+def _evaluate_expression(expression, variables, absent):
+    try:
+        value, assignments = evaluate(expression, variables, absent)
+    except Exception as error:
+        # Not just EvaluationError: a bad variable value, say, must not
+        # lose the results of every other expression.
+        return BulkResult(None, None, error)
+    return BulkResult(value, assignments, None)
+
+
+def _evaluate_file(args, variables, absent):
+    path, encoding = args
+    try:
+        # newline='' so that line endings pass through unchanged.
+        with io.open(path, encoding=encoding, newline='') as f:
+            expression = f.read()
+    except (EnvironmentError, ValueError) as error:
+        # ValueError includes UnicodeDecodeError.
+        return BulkResult(None, None, error)
+    return _evaluate_expression(expression, variables, absent)
+
+
+def _map(function, items, variables, absent, processes, chunksize):
+    """Call function(item, variables, absent) for each of items in worker
+    processes, yielding the results in order.
+    """
+    if processes == 1:
+        for item in items:
+            yield function(item, variables, absent)
+        return
+    import multiprocessing
+    pool = multiprocessing.Pool(
+        processes, initializer=_initialize, initargs=(variables, absent))
+    try:
+        for result in pool.imap(
+                functools.partial(_in_worker, function), items, chunksize):
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def evaluate_bulk(expressions, variables, absent=EMPTY, processes=None,
+                  chunksize=64):
+    """Evaluate many expressions with the same variables in parallel.
+
+    The variables are sent to each worker process once, when it starts, and
+    expressions are sent to the workers in batches of chunksize.
+
+    :param expressions: An iterable of shell expressions.
+    :param variables: A mapping of the variables available to every
+        expression. It is copied once, before any worker is started.
+    :param absent: As for ``shellvars.evaluate``.
+    :param processes: The number of worker processes, by default the number
+        of CPUs. If 1, the expressions are evaluated in this process.
+    :param chunksize: How many expressions to send to a worker at a time.
+    :return: An iterator of BulkResult, in the order of expressions. Any
+        exception evaluating an expression raises, including
+        EvaluationError, is reported in the BulkResult of its expression.
+    """
+    _check_absent(absent)
+    return _map(
+        _evaluate_expression, expressions, dict(variables), absent, processes,
+        chunksize)
+
+
+def evaluate_files(paths, variables, absent=EMPTY, processes=None,
+                   chunksize=8, encoding='utf-8'):
+    """Evaluate the contents of many files in parallel.
+
+    Each file is read by the worker process that evaluates it. Errors reading
+    or decoding a file are reported in its BulkResult like errors evaluating
+    it. See ``evaluate_bulk`` for the other parameters.
+
+    :param paths: An iterable of the paths of the files.
+    :param encoding: The encoding of the files.
+    :return: An iterator of BulkResult, in the order of paths.
+    """
+    _check_absent(absent)
+    items = ((path, encoding) for path in paths)
+    return _map(
+        _evaluate_file, items, dict(variables), absent, processes, chunksize)
+
+
+def main(argv=None, stdout=None, stderr=None):
+    """Evaluate files from the command line.
+
+    :return: The exit code: 0 if every file was evaluated, otherwise 1.
+    """
+    import argparse
+    parser = argparse.ArgumentParser(
+        prog='python -m shellvars',
+        description='Evaluate shell variable expressions in files.')
+    parser.add_argument('files', nargs='+', metavar='FILE')
+    parser.add_argument(
+        '-o', '--output-dir', metavar='DIR',
+        help='Write each evaluated file to DIR, under its base name, rather '
+        'than to stdout.')
+    parser.add_argument(
+        '-e', '--set', action='append', default=[], metavar='NAME=VALUE',
+        help='Set a variable. May be given more than once.')
+    parser.add_argument(
+        '-i', '--ignore-environment', action='store_true',
+        help='Do not make the environment variables available.')
+    parser.add_argument(
+        '--skip', action='store_true',
+        help='Leave expressions for unset variables unevaluated.')
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=None,
+        help='The number of worker processes (default: number of CPUs).')
+    parser.add_argument('--encoding', default='utf-8')
+    args = parser.parse_args(argv)
+    stdout = stdout or sys.stdout
+    stderr = stderr or sys.stderr
+    variables = {} if args.ignore_environment else dict(os.environ)
+    for setting in args.set:
+        name, sep, value = setting.partition('=')
+        if not sep:
+            parser.error('invalid variable %r, expected NAME=VALUE' % (
+                setting,))
+        variables[name] = value
+    results = evaluate_files(
+        args.files, variables, SKIP if args.skip else EMPTY, args.jobs,
+        encoding=args.encoding)
+    status = 0
+    # The file each output file was written for.
+    written = {}
+    for path, result in zip(args.files, results):
+        if result.error is not None:
+            stderr.write('%s: %s\n' % (path, result.error))
+            status = 1
+        elif args.output_dir:
+            target = os.path.join(args.output_dir, os.path.basename(path))
+            if target in written:
+                stderr.write('%s: %s was already written for %s\n' % (
+                    path, target, written[target]))
+                status = 1
+                continue
+            written[target] = path
+            with io.open(
+                    target, 'w', encoding=args.encoding, newline='') as f:
+                f.write(result.value)
+        else:
+            stdout.write(result.value)
+    return status
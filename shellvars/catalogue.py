@@ -0,0 +1,370 @@
+# Copyright (c) 2015 Robert Collins <robertc@robertcollins.net>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Save parsed expressions to a file and load them back without parsing.
+
+A catalogue file is laid out as follows, with all integers little-endian:
+
+* A header: the magic string, the format version, the number of templates,
+  the size of the file and a CRC32 of the index.
+* The records, one for each template: a CRC32 of the rest of the record,
+  the length of the key in bytes, the number of codes, the key and then the
+  codes. The key is b't' followed by the expression encoded as UTF-8 if the
+  expression is text, or b'b' followed by the expression if it is bytes.
+* The index: the offset of each record, ordered by key.
+
+The codes describe the nodes of the expression in order, by their length
+in characters, or bytes for a bytes expression: (0, length) is a _Literal,
+(1, length) a _SimpleExpression, (2, length of name) starts an _Expression,
+whose null and op follow the name in the expression, and (3,) ends the word
+of the innermost _Expression.
+"""
+
+__all__ = ['Catalogue', 'CatalogueError', 'load_catalogue', 'save_catalogue']
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+import io
+import mmap
+import struct
+import zlib
+
+from shellvars import (
+    Template,
+    _Expression,
+    _Literal,
+    _SimpleExpression,
+    _ops,
+    _scan,
+    _syntax,
+    compile,
+    )
+
+_MAGIC = b'SHVC'
+# Increased whenever the layout of the file or the meaning of the codes
+# changes.
+FORMAT_VERSION = 2
+
+_header = struct.Struct('<4sIIQI')
+_record = struct.Struct('<III')
+_offset = struct.Struct('<Q')
+_text = type(u'')
+
+# The op of an _Expression, which is str even in bytes expressions, by its
+# text.
+_op_names = dict((op, op) for op in _ops)
+_op_names.update((op.encode('ascii'), op) for op in _ops)
+
+
+class CatalogueError(ValueError):
+    """A catalogue file is not valid."""
+
+
+def _encode_key(expression):
+    """Return the key of expression in a catalogue file.
+
+    :return: The key, or None if expression is neither text nor bytes.
+    """
+    if isinstance(expression, bytes):
+        return b'b' + expression
+    if isinstance(expression, _text):
+        return b't' + expression.encode('utf-8')
+    return None
+
+
+def _decode_key(key):
+    """Return the expression whose key is key."""
+    kind = key[:1]
+    if kind == b'b':
+        return key[1:]
+    if kind == b't':
+        try:
+            return key[1:].decode('utf-8')
+        except UnicodeDecodeError:
+            pass
+    raise CatalogueError('invalid key %r' % (key,))
+
+
+def _encode(nodes):
+    """Return the codes describing nodes."""
+    codes = []
+    # Nodes, and None for the end of each expression, in reverse order.
+    pending = list(reversed(nodes))
+    while pending:
+        node = pending.pop()
+        if node is None:
+            codes.append(3)
+        elif type(node) == _Literal:
+            codes.extend((0, len(node.value)))
+        elif type(node) == _SimpleExpression:
+            codes.extend((1, len(node.text)))
+        else:
+            codes.extend((2, len(node.name)))
+            pending.append(None)
+            pending.extend(reversed(node.word))
+    return codes
+
+
+def _decode(expression, codes):
+    """Return the nodes of expression described by codes."""
+    syntax = _syntax(expression)
+    nodes = []
+    # The nodes of the expressions whose words are being decoded.
+    stack = []
+    pos = 0
+    index = 0
+    end = len(codes)
+    while index < end:
+        code = codes[index]
+        if code == 0:
+            length = codes[index + 1]
+            nodes.append(_Literal(expression[pos:pos + length]))
+            pos += length
+            index += 2
+        elif code == 1:
+            length = codes[index + 1]
+            text = expression[pos:pos + length]
+            if text[1:2] == syntax.open_brace:
+                name = text[2:-1]
+            else:
+                name = text[1:]
+            nodes.append(_SimpleExpression(name, text))
+            pos += length
+            index += 2
+        elif code == 2:
+            start = pos + 2
+            pos = start + codes[index + 1]
+            name = expression[start:pos]
+            null = None
+            if expression[pos:pos + 1] == syntax.colon:
+                null = ':'
+                pos += 1
+            op = _op_names[expression[pos:pos + 1]]
+            stack.append((nodes, name, null, op))
+            nodes = []
+            pos += 1
+            index += 2
+        elif code == 3:
+            parent, name, null, op = stack.pop()
+            parent.append(_Expression(name, null, op, nodes))
+            nodes = parent
+            pos += 1
+            index += 1
+        else:
+            raise CatalogueError('invalid code %r' % (code,))
+    if stack or pos != len(expression):
+        raise CatalogueError('codes do not match %r' % (expression,))
+    return nodes
+
+
+def save_catalogue(expressions, path):
+    """Parse expressions and save them to a catalogue file.
+
+    :param expressions: An iterable of shell expressions, which may be str
+        or bytes. Duplicates are saved once.
+    :param path: The path of the file to write. An existing file is
+        replaced.
+    :return: The number of templates saved.
+    """
+    records = []
+    for expression in set(expressions):
+        key = _encode_key(expression)
+        if key is None:
+            raise TypeError(
+                'expressions must be str or bytes, not %r' % (expression,))
+        codes = _encode(_scan(expression))
+        body = key + struct.pack('<%dI' % len(codes), *codes)
+        crc = zlib.crc32(struct.pack('<II', len(key), len(codes)) + body)
+        records.append(
+            (key, _record.pack(crc & 0xffffffff, len(key), len(codes)) + body))
+    records.sort()
+    offsets = []
+    position = _header.size
+    for _, record in records:
+        offsets.append(position)
+        position += len(record)
+    index = b''.join(_offset.pack(offset) for offset in offsets)
+    size = position + len(index)
+    with io.open(path, 'wb') as f:
+        f.write(_header.pack(
+            _MAGIC, FORMAT_VERSION, len(records), size,
+            zlib.crc32(index) & 0xffffffff))
+        for _, record in records:
+            f.write(record)
+        f.write(index)
+    return len(records)
+
+
+def load_catalogue(path):
+    """Load a catalogue file saved by ``save_catalogue``.
+
+    The file is mapped into memory rather than read, and only the header and
+    index are checked: each template is decoded and checked the first time it
+    is looked up.
+
+    :raises CatalogueError: If the file is not a catalogue, was saved with a
+        different format version or has been truncated or corrupted.
+    :return: A Catalogue.
+    """
+    with io.open(path, 'rb') as f:
+        try:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # The file is empty.
+            raise CatalogueError('%s: not a catalogue' % (path,))
+    try:
+        return Catalogue(data, path)
+    except CatalogueError:
+        data.close()
+        raise
+
+
+class Catalogue(Mapping):
+    """A read-only mapping from expressions to their Templates.
+
+    Create one with ``load_catalogue``. Templates are decoded when they are
+    first looked up, and then kept. Each record is checked the first time it
+    is read, by a lookup or by iterating over the catalogue, which raises
+    CatalogueError if the record is corrupt.
+    """
+
+    def __init__(self, data, name='<catalogue>'):
+        """Create a Catalogue.
+
+        :param data: The contents of a catalogue file, as an object
+            supporting the buffer protocol such as bytes or an mmap.
+        :param name: The name of the file, for error messages.
+        """
+        self._data = data
+        self._name = name
+        if len(data) < _header.size:
+            raise CatalogueError('%s: not a catalogue' % (name,))
+        magic, version, count, size, crc = _header.unpack_from(data, 0)
+        if magic != _MAGIC:
+            raise CatalogueError('%s: not a catalogue' % (name,))
+        if version != FORMAT_VERSION:
+            raise CatalogueError(
+                '%s: format version %d is not supported (expected %d)' % (
+                    name, version, FORMAT_VERSION))
+        self._index = size - count * _offset.size
+        if size != len(data) or self._index < _header.size:
+            raise CatalogueError('%s: truncated' % (name,))
+        if zlib.crc32(data[self._index:size]) & 0xffffffff != crc:
+            raise CatalogueError('%s: index checksum mismatch' % (name,))
+        self._count = count
+        self._templates = {}
+        # The offsets of the records whose checksum has been checked.
+        self._checked = set()
+
+    def _record(self, offset):
+        """Return (key, start of the codes, number of codes) for the record
+        at offset, checking its checksum the first time.
+        """
+        data = self._data
+        if offset < _header.size or offset + _record.size > self._index:
+            raise CatalogueError(
+                '%s: invalid record offset %d' % (self._name, offset))
+        crc, length, count = _record.unpack_from(data, offset)
+        start = offset + _record.size
+        end = start + length + count * 4
+        if offset not in self._checked:
+            if (end > self._index
+                    or zlib.crc32(data[offset + 4:end]) & 0xffffffff != crc):
+                raise CatalogueError(
+                    '%s: checksum mismatch at offset %d' % (
+                        self._name, offset))
+            self._checked.add(offset)
+        return data[start:start + length], start + length, count
+
+    def _key(self, position):
+        """Return (key, offset) for the record at position in the index."""
+        offset = _offset.unpack_from(
+            self._data, self._index + position * _offset.size)[0]
+        return self._record(offset)[0], offset
+
+    def _find(self, key):
+        """Return the offset of the record for key, or None."""
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            found, offset = self._key(middle)
+            if found == key:
+                return offset
+            if found < key:
+                low = middle + 1
+            else:
+                high = middle
+        return None
+
+    def _load(self, offset):
+        key, start, count = self._record(offset)
+        expression = _decode_key(key)
+        codes = struct.unpack_from('<%dI' % count, self._data, start)
+        try:
+            nodes = _decode(expression, codes)
+        except (IndexError, KeyError):
+            raise CatalogueError('codes do not match %r' % (expression,))
+        return Template(expression, nodes)
+
+    def __getitem__(self, expression):
+        template = self._templates.get(expression)
+        if template is None:
+            key = _encode_key(expression)
+            offset = None if key is None else self._find(key)
+            if offset is None:
+                raise KeyError(expression)
+            template = self._load(offset)
+            self._templates[expression] = template
+        return template
+
+    def __contains__(self, expression):
+        if expression in self._templates:
+            return True
+        key = _encode_key(expression)
+        return key is not None and self._find(key) is not None
+
+    def __iter__(self):
+        for position in range(self._count):
+            yield _decode_key(self._key(position)[0])
+
+    def __len__(self):
+        return self._count
+
+    def __repr__(self):
+        return 'Catalogue(%r)' % (self._name,)
+
+    def compile(self, expression):
+        """Return the Template for expression.
+
+        :return: The Template from the catalogue, or if expression is not in
+            the catalogue, ``shellvars.compile(expression)``.
+        """
+        try:
+            return self[expression]
+        except KeyError:
+            return compile(expression)
+
+    def close(self):
+        """Close the underlying file. Templates already looked up still work.
+        """
+        if hasattr(self._data, 'close'):
+            self._data.close()
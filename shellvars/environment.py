@@ -0,0 +1,230 @@
+# Copyright (c) 2015 Robert Collins <robertc@robertcollins.net>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Resolve sets of variable definitions that refer to each other."""
+
+__all__ = ['CycleError', 'Environment']
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+import heapq
+
+from shellvars import EMPTY, EvaluationError, _check_absent, compile
+
+
+class CycleError(EvaluationError):
+    """Definitions refer to each other in a cycle."""
+
+
+class _Scope(object):
+    """The variables visible to one definition."""
+
+    __slots__ = ('bindings', 'values', 'variables')
+
+    def __init__(self, bindings, values, variables):
+        self.bindings = bindings
+        self.values = values
+        self.variables = variables
+
+    def get(self, name, default=None):
+        index = self.bindings.get(name)
+        if index is not None:
+            return self.values[index]
+        return self.variables.get(name, default)
+
+
+class _Changed(object):
+    """Variables with some changes that have not been made yet."""
+
+    __slots__ = ('changes', 'removed', 'variables')
+
+    def __init__(self, changes, removed, variables):
+        self.changes = changes
+        self.removed = removed
+        self.variables = variables
+
+    def get(self, name, default=None):
+        if name in self.changes:
+            return self.changes[name]
+        if name in self.removed:
+            return default
+        return self.variables.get(name, default)
+
+
+class Environment(Mapping):
+    """The values of an ordered set of NAME=expression definitions.
+
+    Definitions may refer to each other in any order: they are evaluated in
+    dependency order, so each is evaluated after the definitions it refers
+    to. A definition that refers to its own name sees the previous definition
+    of that name, or the input variable if there is none, so 'PATH=$PATH:/x'
+    extends PATH. When a name is defined more than once, the last definition
+    is its value.
+
+    Assignments made by ${NAME=WORD} inside a definition are only visible to
+    the rest of that definition.
+
+    An Environment is a read-only mapping from each defined name to its
+    value. ``update`` changes the input variables, re-evaluating only the
+    definitions that depend on them.
+    """
+
+    def __init__(self, definitions, variables=None, absent=EMPTY):
+        """Create an Environment.
+
+        :param definitions: An iterable of (name, expression) pairs.
+        :param variables: A mapping of the input variables available to the
+            definitions. It is copied.
+        :param absent: As for ``shellvars.evaluate``.
+        :raises CycleError: If definitions refer to each other in a cycle.
+        :raises EvaluationError: If evaluating a definition fails.
+        """
+        _check_absent(absent)
+        self._absent = absent
+        self._variables = dict(variables or {})
+        self._names = []
+        self._templates = []
+        for name, expression in definitions:
+            self._names.append(name)
+            self._templates.append(compile(expression))
+        # The index of the last definition of each name.
+        self._final = dict(
+            (name, index) for index, name in enumerate(self._names))
+        # For each definition, the definition that provides each name it
+        # refers to. Names absent from it are read from the variables.
+        self._bindings = []
+        # The definitions that refer to each definition.
+        self._dependents = [[] for _ in self._names]
+        # The definitions that read each input variable.
+        self._readers = {}
+        previous = {}
+        for index, (name, template) in enumerate(
+                zip(self._names, self._templates)):
+            bindings = {}
+            for reference in template.analysis.referenced:
+                if reference == name:
+                    provider = previous.get(name)
+                else:
+                    provider = self._final.get(reference)
+                if provider is None:
+                    self._readers.setdefault(reference, []).append(index)
+                else:
+                    bindings[reference] = provider
+                    self._dependents[provider].append(index)
+            self._bindings.append(bindings)
+            previous[name] = index
+        self._order = self._sort()
+        self._position = [None] * len(self._names)
+        for position, index in enumerate(self._order):
+            self._position[index] = position
+        self._values = [None] * len(self._names)
+        for index in self._order:
+            self._values[index] = self._evaluate(
+                index, self._values, self._variables)
+
+    def _sort(self):
+        """Return the definition indices in dependency order."""
+        remaining = [len(bindings) for bindings in self._bindings]
+        ready = [index for index, count in enumerate(remaining) if not count]
+        heapq.heapify(ready)
+        order = []
+        while ready:
+            index = heapq.heappop(ready)
+            order.append(index)
+            for dependent in self._dependents[index]:
+                remaining[dependent] -= 1
+                if not remaining[dependent]:
+                    heapq.heappush(ready, dependent)
+        if len(order) != len(self._names):
+            cycle = sorted(set(
+                self._names[index] for index, count in enumerate(remaining)
+                if count))
+            raise CycleError(
+                "Definitions refer to each other in a cycle: %s" % (
+                    ', '.join(cycle),))
+        return order
+
+    def _evaluate(self, index, values, variables):
+        scope = _Scope(self._bindings[index], values, variables)
+        return self._templates[index].evaluate(scope, self._absent)[0]
+
+    def update(self, changes, removed=()):
+        """Change input variables and re-evaluate the affected definitions.
+
+        Only definitions that read a changed variable, directly or through
+        other definitions, are re-evaluated, and a definition whose value
+        does not change does not cause the definitions that refer to it to be
+        re-evaluated. If evaluating a definition fails, the Environment is
+        left unchanged.
+
+        :param changes: A mapping of input variables to set.
+        :param removed: Names of input variables to unset.
+        :return: The set of defined names whose value changed.
+        """
+        variables = self._variables
+        removed = set(
+            name for name in removed
+            if name in variables and name not in changes)
+        changes = dict(
+            (name, value) for name, value in changes.items()
+            if name not in variables or variables[name] != value)
+        changed = set(changes) | removed
+        pending = []
+        queued = set()
+        for name in changed:
+            for index in self._readers.get(name, ()):
+                if index not in queued:
+                    queued.add(index)
+                    heapq.heappush(pending, self._position[index])
+        values = list(self._values)
+        changed_variables = _Changed(changes, removed, variables)
+        updated = set()
+        while pending:
+            index = self._order[heapq.heappop(pending)]
+            value = self._evaluate(index, values, changed_variables)
+            if value == values[index]:
+                continue
+            values[index] = value
+            updated.add(index)
+            for dependent in self._dependents[index]:
+                if dependent not in queued:
+                    queued.add(dependent)
+                    heapq.heappush(pending, self._position[dependent])
+        variables.update(changes)
+        for name in removed:
+            del variables[name]
+        self._values = values
+        return set(
+            self._names[index] for index in updated
+            if self._final[self._names[index]] == index)
+
+    def __getitem__(self, name):
+        return self._values[self._final[name]]
+
+    def __iter__(self):
+        return iter(self._final)
+
+    def __len__(self):
+        return len(self._final)
+
+    def __repr__(self):
+        return 'Environment(%r)' % (dict(self),)
@@ -0,0 +1,160 @@
+# Copyright (c) 2015 Robert Collins <robertc@robertcollins.net>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import io
+import os
+import shutil
+import tempfile
+
+from testtools import TestCase
+from testtools.matchers import Equals, IsInstance, raises
+
+from shellvars import SKIP, EvaluationError
+from shellvars.bulk import BulkResult, evaluate_bulk, evaluate_files, main
+
+
+class TestEvaluateBulk(TestCase):
+
+    scenarios = [
+        ('in-process', {'processes': 1}),
+        ('pool', {'processes': 2}),
+        ]
+
+    def test_in_order(self):
+        expressions = ['$n%d' % (i,) for i in range(200)]
+        variables = dict(('n%d' % (i,), str(i)) for i in range(200))
+        results = evaluate_bulk(
+            expressions, variables, processes=self.processes, chunksize=7)
+        self.expectThat(
+            list(results),
+            Equals([BulkResult(str(i), {}, None) for i in range(200)]))
+
+    def test_absent_and_assignments(self):
+        results = evaluate_bulk(
+            ['${a:=b}', '$c'], {}, SKIP, processes=self.processes)
+        self.expectThat(list(results), Equals([
+            BulkResult('${a:=b}', {}, None), BulkResult('$c', {}, None)]))
+
+    def test_errors_per_item(self):
+        results = list(evaluate_bulk(
+            ['$a', '${b:?missing}', '$a'], {'a': 'x'},
+            processes=self.processes))
+        self.expectThat(results[0], Equals(BulkResult('x', {}, None)))
+        self.expectThat(results[1].value, Equals(None))
+        self.expectThat(results[1].error, IsInstance(EvaluationError))
+        self.expectThat(str(results[1].error), Equals('missing'))
+        self.expectThat(results[2], Equals(BulkResult('x', {}, None)))
+
+    def test_other_errors_per_item(self):
+        results = list(evaluate_bulk(
+            ['$a', '$n', 'x'], {'a': '1', 'n': 5}, processes=self.processes))
+        self.expectThat(results[0], Equals(BulkResult('1', {}, None)))
+        self.expectThat(results[1].value, Equals(None))
+        self.expectThat(results[1].error, IsInstance(TypeError))
+        self.expectThat(results[2], Equals(BulkResult('x', {}, None)))
+
+    def test_interleaved(self):
+        first = evaluate_bulk(
+            ['$x', '$x'], {'x': '1'}, SKIP, processes=self.processes)
+        self.expectThat(next(first), Equals(BulkResult('1', {}, None)))
+        second = evaluate_bulk(['$x $y'], {'x': '2'}, processes=self.processes)
+        self.expectThat(next(second), Equals(BulkResult('2 ', {}, None)))
+        self.expectThat(next(first), Equals(BulkResult('1', {}, None)))
+        third = evaluate_bulk(['$y'], {}, SKIP, processes=self.processes)
+        self.expectThat(list(third), Equals([BulkResult('$y', {}, None)]))
+
+    def test_invalid_absent(self):
+        self.expectThat(
+            lambda: evaluate_bulk([], {}, None, processes=self.processes),
+            raises(ValueError("invalid value for absent None")))
+
+
+class TestEvaluateFiles(TestCase):
+
+    def setUp(self):
+        super(TestEvaluateFiles, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def write(self, name, content):
+        path = os.path.join(self.directory, name)
+        with io.open(path, 'w', encoding='utf-8', newline='') as f:
+            f.write(content)
+        return path
+
+    def test_files(self):
+        paths = [self.write('a', u'$x'), self.write('b', u'${x:-y}z')]
+        missing = os.path.join(self.directory, 'missing')
+        results = list(evaluate_files(
+            paths + [missing], {'x': 'X'}, processes=2))
+        self.expectThat(results[:2], Equals([
+            BulkResult('X', {}, None), BulkResult('Xz', {}, None)]))
+        self.expectThat(results[2].error, IsInstance(EnvironmentError))
+
+    def test_main_stdout(self):
+        paths = [self.write('a', u'$x\n'), self.write('b', u'${y:-$x}\n')]
+        stdout = io.StringIO()
+        status = main(
+            ['-i', '-e', 'x=1', '-j', '1'] + paths, stdout=stdout)
+        self.expectThat(status, Equals(0))
+        self.expectThat(stdout.getvalue(), Equals(u'1\n1\n'))
+
+    def test_main_output_dir(self):
+        path = self.write('a', u'$x ${y}')
+        output = os.path.join(self.directory, 'output')
+        os.mkdir(output)
+        status = main(['-i', '--skip', '-e', 'x=1', '-o', output, path])
+        self.expectThat(status, Equals(0))
+        with io.open(os.path.join(output, 'a'), encoding='utf-8') as f:
+            self.expectThat(f.read(), Equals(u'1 ${y}'))
+
+    def test_main_output_dir_line_endings(self):
+        path = self.write('a', u'$x\r\n${y:-z}\r\n')
+        output = os.path.join(self.directory, 'output')
+        os.mkdir(output)
+        status = main(['-i', '-e', 'x=1', '-o', output, path])
+        self.expectThat(status, Equals(0))
+        with io.open(os.path.join(output, 'a'), 'rb') as f:
+            self.expectThat(f.read(), Equals(b'1\r\nz\r\n'))
+
+    def test_main_output_dir_same_name(self):
+        os.mkdir(os.path.join(self.directory, 'b'))
+        first = self.write('a', u'first')
+        second = self.write(os.path.join('b', 'a'), u'second')
+        output = os.path.join(self.directory, 'output')
+        os.mkdir(output)
+        stderr = io.StringIO()
+        status = main(['-i', '-o', output, first, second], stderr=stderr)
+        self.expectThat(status, Equals(1))
+        target = os.path.join(output, 'a')
+        with io.open(target, encoding='utf-8') as f:
+            self.expectThat(f.read(), Equals(u'first'))
+        self.expectThat(stderr.getvalue(), Equals(
+            u'%s: %s was already written for %s\n' % (second, target, first)))
+
+    def test_main_errors(self):
+        path = self.write('a', u'${x:?x is required}')
+        stdout = io.StringIO()
+        stderr = io.StringIO()
+        status = main(['-i', '-j', '1', path], stdout=stdout, stderr=stderr)
+        self.expectThat(status, Equals(1))
+        self.expectThat(stdout.getvalue(), Equals(u''))
+        self.expectThat(
+            stderr.getvalue(), Equals(u'%s: x is required\n' % (path,)))
@@ -0,0 +1,204 @@
+# Copyright (c) 2015 Robert Collins <robertc@robertcollins.net>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os
+import shutil
+import struct
+import tempfile
+import zlib
+
+from testtools import TestCase
+from testtools.matchers import Equals, IsInstance, Not, raises
+
+from shellvars import SKIP, Template, _scan, cache_info
+from shellvars.catalogue import (
+    Catalogue, CatalogueError, FORMAT_VERSION, load_catalogue,
+    save_catalogue)
+
+
+expressions = [
+    '',
+    'literal',
+    '$a ${b} text',
+    'pre ${a:-${b:=${c?bad}}} ${d+x$e} post',
+    '${a:-unclosed',
+    '$1 $ } ${}',
+    '\xe9${\xe9t\xe9:-caf\xe9}',
+    ]
+
+
+class TestCatalogue(TestCase):
+
+    def setUp(self):
+        super(TestCatalogue, self).setUp()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'templates.shvc')
+
+    def load(self):
+        catalogue = load_catalogue(self.path)
+        self.addCleanup(catalogue.close)
+        return catalogue
+
+    def corrupt(self, offset, data):
+        with open(self.path, 'r+b') as f:
+            f.seek(offset)
+            f.write(data)
+
+    def test_round_trip(self):
+        count = save_catalogue(expressions + expressions[:2], self.path)
+        self.expectThat(count, Equals(len(expressions)))
+        catalogue = self.load()
+        self.expectThat(len(catalogue), Equals(len(expressions)))
+        self.expectThat(sorted(catalogue), Equals(sorted(expressions)))
+        for expression in expressions:
+            template = catalogue[expression]
+            self.expectThat(template, IsInstance(Template))
+            self.expectThat(template.expression, Equals(expression))
+            self.expectThat(template.nodes, Equals(_scan(expression)))
+
+    def test_evaluate(self):
+        save_catalogue(['${a:-${b:=x}} $c'], self.path)
+        template = self.load()['${a:-${b:=x}} $c']
+        self.expectThat(
+            template.evaluate({'c': 'y'}), Equals(('x y', {'b': 'x'})))
+        self.expectThat(
+            template.evaluate({'c': 'y'}, SKIP),
+            Equals(('${a:-${b:=x}} y', {})))
+
+    def test_lazy(self):
+        save_catalogue(expressions, self.path)
+        catalogue = self.load()
+        self.expectThat(catalogue._templates, Equals({}))
+        self.expectThat('literal' in catalogue, Equals(True))
+        self.expectThat('missing' in catalogue, Equals(False))
+        self.expectThat(catalogue._templates, Equals({}))
+        template = catalogue['literal']
+        self.expectThat(list(catalogue._templates), Equals(['literal']))
+        self.expectThat(catalogue['literal'], Equals(template))
+
+    def test_missing(self):
+        save_catalogue(expressions, self.path)
+        catalogue = self.load()
+        self.expectThat(lambda: catalogue['missing'], raises(KeyError))
+        self.expectThat(catalogue.get('missing'), Equals(None))
+
+    def test_compile(self):
+        save_catalogue(['$a'], self.path)
+        catalogue = self.load()
+        self.expectThat(catalogue.compile('$a'), Equals(catalogue['$a']))
+        misses = cache_info().misses
+        template = catalogue.compile('$b $c')
+        self.expectThat(template.evaluate({'b': 'x'}), Equals(('x ', {})))
+        self.expectThat(cache_info().misses, Not(Equals(misses)))
+
+    def test_bytes(self):
+        save_catalogue(expressions, self.path)
+        with open(self.path, 'rb') as f:
+            catalogue = Catalogue(f.read())
+        self.expectThat(
+            catalogue['$a ${b} text'].evaluate({'a': 'x'}),
+            Equals(('x  text', {})))
+
+    def test_bytes_expressions(self):
+        mixed = expressions + [
+            b'$a ${b:-${c:=x}} \xff', b'${a+\xff}', b'${a:-unclosed \xff']
+        save_catalogue(mixed, self.path)
+        catalogue = self.load()
+        self.expectThat(len(catalogue), Equals(len(mixed)))
+        self.expectThat(set(catalogue), Equals(set(mixed)))
+        for expression in mixed:
+            template = catalogue[expression]
+            self.expectThat(template.expression, IsInstance(type(expression)))
+            self.expectThat(template.nodes, Equals(_scan(expression)))
+        self.expectThat(
+            catalogue[b'$a ${b:-${c:=x}} \xff'].evaluate({b'a': b'y'}),
+            Equals((b'y x \xff', {b'c': b'x'})))
+
+    def test_empty_file(self):
+        open(self.path, 'wb').close()
+        self.expectThat(
+            lambda: load_catalogue(self.path), raises(CatalogueError))
+
+    def test_not_a_catalogue(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'not a catalogue file at all, but long enough')
+        self.expectThat(
+            lambda: load_catalogue(self.path), raises(CatalogueError))
+
+    def test_version(self):
+        save_catalogue(expressions, self.path)
+        self.corrupt(4, struct.pack('<I', FORMAT_VERSION + 1))
+        self.expectThat(
+            lambda: load_catalogue(self.path), raises(CatalogueError))
+
+    def test_truncated(self):
+        save_catalogue(expressions, self.path)
+        with open(self.path, 'r+b') as f:
+            f.truncate(os.path.getsize(self.path) - 1)
+        self.expectThat(
+            lambda: load_catalogue(self.path), raises(CatalogueError))
+
+    def test_corrupt_index(self):
+        save_catalogue(expressions, self.path)
+        self.corrupt(os.path.getsize(self.path) - 1, b'\xff')
+        self.expectThat(
+            lambda: load_catalogue(self.path), raises(CatalogueError))
+
+    def test_corrupt_record(self):
+        save_catalogue(['$a'], self.path)
+        # The expression of the only record follows the header, the record
+        # header and the type of the key.
+        self.corrupt(24 + 12 + 1, b'$b')
+        catalogue = self.load()
+        self.expectThat(lambda: catalogue['$b'], raises(CatalogueError))
+        self.expectThat(lambda: catalogue['$a'], raises(CatalogueError))
+        self.expectThat(lambda: list(catalogue), raises(CatalogueError))
+
+    def test_corrupt_key_length(self):
+        save_catalogue(['$a'], self.path)
+        # The length of the key of the only record.
+        self.corrupt(24 + 4, struct.pack('<I', 1000))
+        catalogue = self.load()
+        self.expectThat(lambda: list(catalogue), raises(CatalogueError))
+        self.expectThat(lambda: '$a' in catalogue, raises(CatalogueError))
+
+    def test_invalid_key(self):
+        # A record whose checksum matches but whose key is not valid UTF-8.
+        key = b't\xff'
+        body = key + struct.pack('<2I', 0, 1)
+        record = struct.pack(
+            '<III', zlib.crc32(struct.pack('<II', len(key), 2) + body)
+            & 0xffffffff, len(key), 2) + body
+        index = struct.pack('<Q', 24)
+        data = struct.pack(
+            '<4sIIQI', b'SHVC', FORMAT_VERSION, 1, 24 + len(record) + 8,
+            zlib.crc32(index) & 0xffffffff) + record + index
+        catalogue = Catalogue(data)
+        self.expectThat(lambda: list(catalogue), raises(CatalogueError))
+
+    def test_other_keys(self):
+        save_catalogue(['$a'], self.path)
+        catalogue = self.load()
+        self.expectThat(catalogue.get(5), Equals(None))
+        self.expectThat(5 in catalogue, Equals(False))
+        self.expectThat(lambda: catalogue[5], raises(KeyError))
+        self.expectThat(
+            lambda: save_catalogue([5], self.path), raises(TypeError))
@@ -0,0 +1,106 @@
+# Copyright (c) 2015 Robert Collins <robertc@robertcollins.net>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+from testtools import TestCase
+from testtools.matchers import Equals, raises
+
+from shellvars import EvaluationError, SKIP
+from shellvars.environment import CycleError, Environment
+
+
+class CountingEnvironment(Environment):
+    """An Environment that records which definitions it evaluates."""
+
+    def __init__(self, *args, **kwargs):
+        self.evaluated = []
+        super(CountingEnvironment, self).__init__(*args, **kwargs)
+
+    def _evaluate(self, index, values, variables):
+        self.evaluated.append(self._names[index])
+        return super(CountingEnvironment, self)._evaluate(
+            index, values, variables)
+
+
+class TestEnvironment(TestCase):
+
+    def test_order_independent(self):
+        environment = Environment([
+            ('URL', '$SCHEME://$HOST:${PORT:-80}'),
+            ('HOST', '${HOSTNAME:-localhost}'),
+            ('SCHEME', 'http'),
+            ], {'PORT': '8080'})
+        self.expectThat(dict(environment), Equals({
+            'URL': 'http://localhost:8080',
+            'HOST': 'localhost',
+            'SCHEME': 'http',
+            }))
+
+    def test_self_reference(self):
+        environment = Environment([
+            ('PATH', '$PATH:/a'),
+            ('PATH', '$PATH:/b'),
+            ('BIN', '$PATH'),
+            ], {'PATH': '/usr/bin'})
+        self.expectThat(environment['PATH'], Equals('/usr/bin:/a:/b'))
+        self.expectThat(environment['BIN'], Equals('/usr/bin:/a:/b'))
+
+    def test_cycle(self):
+        self.expectThat(
+            lambda: Environment([('A', '$B'), ('B', '${C:-$A}'), ('C', 'x')]),
+            raises(CycleError(
+                "Definitions refer to each other in a cycle: A, B")))
+
+    def test_cycle_is_evaluation_error(self):
+        self.expectThat(issubclass(CycleError, EvaluationError), Equals(True))
+
+    def test_skip(self):
+        environment = Environment([('A', '$B $C')], {'B': 'b'}, SKIP)
+        self.expectThat(environment['A'], Equals('b $C'))
+
+    def test_update_only_reevaluates_affected(self):
+        environment = CountingEnvironment([
+            ('A', '$SECRET'),
+            ('B', '${A:+set}'),
+            ('C', '$B-$A'),
+            ('D', '$OTHER'),
+            ], {'SECRET': 'x', 'OTHER': 'y'})
+        self.expectThat(environment.evaluated, Equals(['A', 'B', 'C', 'D']))
+        environment.evaluated = []
+        self.expectThat(
+            environment.update({'SECRET': 'z', 'OTHER': 'y'}),
+            Equals(set(['A', 'C'])))
+        # D does not depend on SECRET, and OTHER did not change.
+        self.expectThat(environment.evaluated, Equals(['A', 'B', 'C']))
+        self.expectThat(environment['C'], Equals('set-z'))
+        environment.evaluated = []
+        self.expectThat(
+            environment.update({}, removed=['SECRET']),
+            Equals(set(['A', 'B', 'C'])))
+        self.expectThat(environment['C'], Equals('-'))
+
+    def test_failed_update_changes_nothing(self):
+        environment = Environment(
+            [('A', '${SECRET:?missing}'), ('B', '$OTHER')],
+            {'SECRET': 'x', 'OTHER': 'y'})
+        self.expectThat(
+            lambda: environment.update({'OTHER': 'z'}, removed=['SECRET']),
+            raises(EvaluationError('missing')))
+        self.expectThat(dict(environment), Equals({'A': 'x', 'B': 'y'}))
+        self.expectThat(environment.update({'OTHER': 'z'}), Equals(set('B')))
@@ -0,0 +1,113 @@
+# Copyright (c) 2015 Robert Collins <robertc@robertcollins.net>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import sys
+
+from testtools import TestCase, skipIf
+from testtools.matchers import Equals, raises
+
+from shellvars import EMPTY, SKIP, EvaluationError, Resolver, evaluate
+
+if sys.version_info >= (3, 7):
+    import asyncio
+    from shellvars import evaluate_async
+    from shellvars.tests import _aio
+
+
+class FakeStore(object):
+    """A slow variable store that records which variables were fetched."""
+
+    def __init__(self, values):
+        self.values = values
+        self.fetched = []
+        # The lookups in progress, and the most there have been at once.
+        self.active = 0
+        self.most = 0
+
+    def lookup(self, name):
+        self.fetched.append(name)
+        return self.values[name]
+
+    def lookup_async(self, name):
+        return _aio.lookup(self, name)
+
+
+class TestResolver(TestCase):
+
+    def test_only_reached_variables_are_fetched(self):
+        store = FakeStore({'a': 'x', 'c': ''})
+        self.expectThat(
+            evaluate('${a:-$b} ${c:-$d} $a', Resolver(store.lookup)),
+            Equals(('x  x', {})))
+        self.expectThat(store.fetched, Equals(['a', 'c', 'd']))
+
+
+@skipIf(sys.version_info < (3, 7), "asyncio.run needs Python 3.7")
+class TestEvaluateAsync(TestCase):
+
+    scenarios = [
+        ('absent-empty', {'absent': EMPTY}),
+        ('absent-skip', {'absent': SKIP}),
+        ]
+
+    def check(self, expression, values):
+        store = FakeStore(values)
+        result = asyncio.run(
+            evaluate_async(expression, store.lookup_async, self.absent))
+        self.expectThat(
+            result, Equals(evaluate(expression, values, self.absent)))
+        self.store = store
+        return store.fetched
+
+    def test_matches_evaluate(self):
+        for expression in (
+                '', '$a', '${a:-$b} ${c:=${d:-x}} $c', '${a:+${b:+$c}}',
+                '${b:=y}${b:-$c}'):
+            for values in ({}, {'a': 'a', 'b': '', 'c': 'c', 'd': 'd'}):
+                self.check(expression, values)
+
+    def test_fetches_only_reached_variables(self):
+        fetched = self.check('$a ${b:-$c} ${d:-$e}', {'b': 'b', 'd': ''})
+        self.expectThat(sorted(fetched), Equals(['a', 'b', 'd', 'e']))
+
+    def test_fetches_words_concurrently(self):
+        fetched = self.check('${a:-$b ${c:-$d} $e} ${f:?}', {'f': 'f'})
+        if self.absent is SKIP:
+            self.expectThat(fetched, Equals(['a', 'f']))
+        else:
+            self.expectThat(fetched, Equals(['a', 'f', 'b', 'c', 'e', 'd']))
+            self.expectThat(self.store.most, Equals(3))
+
+    def test_deep_nesting(self):
+        expression = 'x'
+        for level in range(200):
+            expression = '${n%d:-%s}' % (level, expression)
+        fetched = self.check(expression, {})
+        if self.absent is SKIP:
+            self.expectThat(fetched, Equals(['n199']))
+        else:
+            self.expectThat(len(fetched), Equals(200))
+
+    def test_errors(self):
+        store = FakeStore({})
+        coroutine = evaluate_async('${a:?missing}', store.lookup_async)
+        self.expectThat(
+            lambda: asyncio.run(coroutine),
+            raises(EvaluationError('missing')))
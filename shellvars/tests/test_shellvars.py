@@ -18,6 +18,15 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import io
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+import subprocess
+import sys
+import threading
+
 try:
     from hypothesis import given
 # To debug hypothesis
@@ -28,11 +37,13 @@ except:
     given = None
 from testscenarios import multiply_scenarios
 from testtools import TestCase, skip
-from testtools.matchers import Equals, Raises, raises, Matcher
+from testtools.matchers import (
+    Equals, GreaterThan, Is, IsInstance, LessThan, MatchesException, Raises,
+    raises, Matcher)
 
 if given is None:
     # Hypothesis not available
-    def text():
+    def text(*args, **kwargs):
         pass
     from collections import namedtuple
     st = namedtuple('st', 'text')(text)
@@ -41,14 +52,34 @@ if given is None:
 
 
 from shellvars import (
+    Analysis,
+    CacheInfo,
+    CODEGEN,
     EMPTY,
     EvaluationError,
+    INTERPRET,
+    Instrumentation,
+    ResultCache,
     SKIP,
+    Template,
     _Expression,
     _Literal,
     _SimpleExpression,
+    _assemble,
+    _disassemble,
     _grammar,
+    _scan,
+    _source,
+    analyze,
+    cache_clear,
+    cache_info,
+    compile,
     evaluate,
+    evaluate_columns,
+    evaluate_many,
+    evaluate_stream,
+    instrument,
+    set_cache_size,
     )
 
 
@@ -65,26 +96,42 @@ class Eval(Matcher):
         return "Eval(%(matcher)s)" % {'matcher': self.matcher}
 
 
-class TestEvaluate(TestCase):
+class BackendMixin(object):
+    """Run tests against each backend."""
 
-    scenarios = [
+    def evaluate(self, expression, variables, absent):
+        if self.backend is None:
+            return evaluate(expression, variables, absent)
+        return compile(expression, self.backend).evaluate(variables, absent)
+
+
+backend_scenarios = [
+    ('evaluate', {'backend': None}),
+    ('interpret', {'backend': INTERPRET}),
+    ('codegen', {'backend': CODEGEN}),
+    ]
+
+
+class TestEvaluate(BackendMixin, TestCase):
+
+    scenarios = multiply_scenarios([
         ('absent-empty', {'absent': EMPTY}),
         ('absent-skip', {'absent': SKIP}),
-        ]
+        ], backend_scenarios)
 
     def test_nothing(self):
         self.expectThat(
-            evaluate("", {}, self.absent),
+            self.evaluate("", {}, self.absent),
             Equals(("", {})))
 
     def test_simple(self):
         self.expectThat(
-            evaluate("pre $BAR post", {"BAR": "quux"}, self.absent),
+            self.evaluate("pre $BAR post", {"BAR": "quux"}, self.absent),
             Equals(("pre quux post", {})))
 
     @given(st.text())
     def test_hypothesis(self, a_string):
-        evaluate(a_string, {}, self.absent)
+        self.evaluate(a_string, {}, self.absent)
 
     def test_simple_absent(self):
         if self.absent is EMPTY:
@@ -92,19 +139,63 @@ class TestEvaluate(TestCase):
         else:
             result = "$BAR"
         self.expectThat(
-            evaluate("pre $BAR post", {}, self.absent),
+            self.evaluate("pre $BAR post", {}, self.absent),
             Equals(("pre " + result + " post", {})))
 
     def test_braces(self):
         self.expectThat(
-            evaluate("pre ${BAR} post", {"BAR": "quux"}, self.absent),
+            self.evaluate("pre ${BAR} post", {"BAR": "quux"}, self.absent),
             Equals(("pre quux post", {})))
         self.expectThat(
-            evaluate("pre ${BAR} mid ${BAR} post", {"BAR": "quux"}, self.absent),
+            self.evaluate("pre ${BAR} mid ${BAR} post", {"BAR": "quux"}, self.absent),
             Equals(("pre quux mid quux post", {})))
 
 
-class TestFormats(TestCase):
+class TestBytes(BackendMixin, TestCase):
+
+    scenarios = backend_scenarios
+
+    def test_simple(self):
+        self.expectThat(
+            self.evaluate(b"pre $BAR ${BAZ} post", {b"BAR": b"quux"}, EMPTY),
+            Equals((b"pre quux  post", {})))
+
+    def test_not_utf8(self):
+        self.expectThat(
+            self.evaluate(
+                b"\xff$a\xfe${b:-\x80}", {b"a": b"\x81"}, EMPTY),
+            Equals((b"\xff\x81\xfe\x80", {})))
+
+    def test_assign(self):
+        self.expectThat(
+            self.evaluate(b"${a:=${b:+x}}$a", {b"b": b"1"}, EMPTY),
+            Equals((b"xx", {b"a": b"x"})))
+
+    def test_skip(self):
+        self.expectThat(
+            self.evaluate(b"$a ${b} ${c:-${d}}", {b"d": b"x"}, SKIP),
+            Equals((b"$a ${b} ${c:-${d}}", {})))
+
+    def test_non_ascii_name(self):
+        self.expectThat(
+            self.evaluate(b"$\xe9 ${\xe9}", {}, EMPTY),
+            Equals((b"$\xe9 ${\xe9}", {})))
+
+    def test_memoryview(self):
+        self.expectThat(
+            self.evaluate(memoryview(b"$a"), {b"a": b"x"}, EMPTY),
+            Equals((b"x", {})))
+
+    def test_errors(self):
+        self.expectThat(
+            lambda: self.evaluate(b"${a?}", {}, EMPTY),
+            raises(EvaluationError("Variable 'a' null or unset.")))
+        self.expectThat(
+            lambda: self.evaluate(b"${a?\xffbad}", {}, EMPTY),
+            raises(EvaluationError(u"\ufffdbad")))
+
+
+class TestFormats(BackendMixin, TestCase):
 
     scenarios = multiply_scenarios([
         ('absent-empty', {'absent': EMPTY}),
@@ -112,7 +203,7 @@ class TestFormats(TestCase):
         ], [
         ('colon', {'colon': ':'}),
         ('nocolon', {'colon': ''}),
-        ])
+        ], backend_scenarios)
 
     def cons(self, param, op, word):
         return '${%(param)s%(colon)s%(op)s%(word)s}' % {
@@ -125,41 +216,41 @@ class TestFormats(TestCase):
     def test_default_values(self):
         expr = "pre " + self.cons('bar', '-', '${foo}') +" post"
         self.expectThat(
-            evaluate(expr, {'bar': 'quux', 'foo': 'baz'}, self.absent),
+            self.evaluate(expr, {'bar': 'quux', 'foo': 'baz'}, self.absent),
             Equals(('pre quux post', {})))
         if self.colon:
             expected = Equals(('pre baz post', {}))
         else:
             expected = Equals(('pre  post', {}))
         self.expectThat(
-            evaluate(expr, {'bar': '', 'foo': 'baz'}, self.absent),
+            self.evaluate(expr, {'bar': '', 'foo': 'baz'}, self.absent),
             expected)
         if self.absent is EMPTY:
             expected = Equals(('pre baz post', {}))
         else:
             expected = Equals((expr, {}))
         self.expectThat(
-            evaluate(expr, {'foo': 'baz'}, self.absent),
+            self.evaluate(expr, {'foo': 'baz'}, self.absent),
             expected)
 
     def test_assign_default_values(self):
         expr = "pre " + self.cons('bar', '=', '${foo}') +" post"
         self.expectThat(
-            evaluate(expr, {'bar': 'quux', 'foo': 'baz'}, self.absent),
+            self.evaluate(expr, {'bar': 'quux', 'foo': 'baz'}, self.absent),
             Equals(('pre quux post', {'bar': 'quux'})))
         if self.colon:
             expected = Equals(('pre baz post', {'bar': 'baz'}))
         else:
             expected = Equals(('pre  post', {'bar': ''}))
         self.expectThat(
-            evaluate(expr, {'bar': '', 'foo': 'baz'}, self.absent),
+            self.evaluate(expr, {'bar': '', 'foo': 'baz'}, self.absent),
             expected)
         if self.absent is EMPTY:
             expected = Equals(('pre baz post', {'bar': 'baz'}))
         else:
             expected = Equals((expr, {}))
         self.expectThat(
-            evaluate(expr, {'foo': 'baz'}, self.absent),
+            self.evaluate(expr, {'foo': 'baz'}, self.absent),
             expected)
         # Nested assignments bubble up.
         inner = self.cons('bar', '=', 'baz')
@@ -169,7 +260,7 @@ class TestFormats(TestCase):
         else:
             expected = Equals((outer, {}))
         self.expectThat(
-            evaluate(outer, {}, self.absent),
+            self.evaluate(outer, {}, self.absent),
             expected)
         # Assignments are honoured inline
         first = self.cons('foo', '=', 'bar')
@@ -180,70 +271,641 @@ class TestFormats(TestCase):
         else:
             expected = Equals((expr, {}))
         self.expectThat(
-            evaluate(expr, {}, self.absent),
+            self.evaluate(expr, {}, self.absent),
             expected)
 
     def test_error_implicit(self):
         expr = "pre " + self.cons('bar', '?', '') + " post"
         self.expectThat(
-            evaluate(expr, {'bar': 'quux'}, self.absent),
+            self.evaluate(expr, {'bar': 'quux'}, self.absent),
             Equals(('pre quux post', {})))
         if self.colon:
             expected = raises(EvaluationError("Variable 'bar' null or unset."))
         else:
             expected = Eval(Equals(('pre  post', {})))
         self.expectThat(
-            lambda: evaluate(expr, {'bar': ''}, self.absent),
+            lambda: self.evaluate(expr, {'bar': ''}, self.absent),
             expected)
         if self.absent is EMPTY:
             expected = raises(EvaluationError("Variable 'bar' null or unset."))
         else:
             expected = Eval(Equals((expr, {})))
         self.expectThat(
-            lambda: evaluate(expr, {}, self.absent),
+            lambda: self.evaluate(expr, {}, self.absent),
             expected)
 
     def test_error_explicit(self):
         expr = "pre " + self.cons('bar', '?', '$foo') + " post"
         self.expectThat(
-            evaluate(expr, {'bar': 'quux'}, self.absent),
+            self.evaluate(expr, {'bar': 'quux'}, self.absent),
             Equals(('pre quux post', {})))
         if self.colon:
             expected = raises(EvaluationError("baz"))
         else:
             expected = Eval(Equals(('pre  post', {})))
         self.expectThat(
-            lambda: evaluate(expr, {'bar': '', 'foo': 'baz'}, self.absent),
+            lambda: self.evaluate(expr, {'bar': '', 'foo': 'baz'}, self.absent),
             expected)
         if self.absent is EMPTY:
             expected = raises(EvaluationError("baz"))
         else:
             expected = Eval(Equals((expr, {})))
         self.expectThat(
-            lambda: evaluate(expr, {'foo': 'baz'}, self.absent),
+            lambda: self.evaluate(expr, {'foo': 'baz'}, self.absent),
             expected)
 
     def test_alternative_values(self):
         expr = "pre " + self.cons('bar', '+', '${foo}') +" post"
         self.expectThat(
-            evaluate(expr, {'bar': 'quux', 'foo': 'baz'}, self.absent),
+            self.evaluate(expr, {'bar': 'quux', 'foo': 'baz'}, self.absent),
             Equals(('pre baz post', {})))
         if self.colon:
             expected = Equals(('pre  post', {}))
         else:
             expected = Equals(('pre baz post', {}))
         self.expectThat(
-            evaluate(expr, {'bar': '', 'foo': 'baz'}, self.absent),
+            self.evaluate(expr, {'bar': '', 'foo': 'baz'}, self.absent),
             expected)
         if self.absent is EMPTY:
             expected = Equals(('pre  post', {}))
         else:
             expected = Equals((expr, {}))
         self.expectThat(
-            evaluate(expr, {'foo': 'baz'}, self.absent),
+            self.evaluate(expr, {'foo': 'baz'}, self.absent),
             expected)
 
 
+class TestCompile(TestCase):
+
+    def test_returns_template(self):
+        template = compile("pre ${BAR:-baz} post")
+        self.expectThat(template, IsInstance(Template))
+        self.expectThat(template.expression, Equals("pre ${BAR:-baz} post"))
+        self.expectThat(template.nodes, Equals([
+            _Literal('pre '),
+            _Expression('BAR', ':', '-', [_Literal('baz')]),
+            _Literal(' post'),
+            ]))
+
+    def test_evaluate_reuses_template(self):
+        template = compile("${foo:=$bar}")
+        self.expectThat(
+            template.evaluate({'bar': 'quux'}),
+            Equals(('quux', {'foo': 'quux'})))
+        self.expectThat(
+            template.evaluate({'foo': 'baz'}),
+            Equals(('baz', {'foo': 'baz'})))
+        self.expectThat(
+            template.evaluate({}, absent=SKIP),
+            Equals(('${foo:=$bar}', {})))
+
+    def test_evaluate_does_not_mutate_variables(self):
+        variables = {}
+        compile("${foo:=bar}").evaluate(variables)
+        self.expectThat(variables, Equals({}))
+
+    def test_invalid_absent(self):
+        self.expectThat(
+            lambda: compile("$foo").evaluate({}, absent=None),
+            raises(ValueError("invalid value for absent None")))
+
+    def test_invalid_backend(self):
+        self.expectThat(
+            lambda: compile("$foo", None),
+            raises(ValueError("invalid value for backend None")))
+
+    def test_codegen_many(self):
+        template = compile("${foo:=$bar}", CODEGEN)
+        self.expectThat(
+            list(template.evaluate_many([{'bar': 'a'}, {'foo': 'b'}])),
+            Equals([('a', {'foo': 'a'}), ('b', {'foo': 'b'})]))
+
+    def test_codegen_deep_nesting(self):
+        expression = "${a:-" * 100 + "x" + "}" * 100
+        self.expectThat(
+            compile(expression, CODEGEN).evaluate({}),
+            Equals(('x', {})))
+
+
+class LookupOnly(Mapping):
+    """A mapping that records lookups and cannot be copied."""
+
+    def __init__(self, variables):
+        self.variables = variables
+        self.lookups = []
+
+    def __getitem__(self, name):
+        self.lookups.append(name)
+        return self.variables[name]
+
+    def __iter__(self):
+        raise AssertionError("variables were copied")
+
+    def __len__(self):
+        raise AssertionError("variables were copied")
+
+
+class TestVariables(TestCase):
+
+    def test_not_copied(self):
+        variables = LookupOnly({'foo': 'a'})
+        self.expectThat(
+            evaluate("$foo ${bar:-$foo}", variables),
+            Equals(('a a', {})))
+        self.expectThat(variables.lookups, Equals(['foo', 'bar', 'foo']))
+
+    def test_assignments_not_written_back(self):
+        variables = LookupOnly({'foo': 'a'})
+        self.expectThat(
+            evaluate("${bar:=$foo}$bar${foo:=b}", variables),
+            Equals(('aaa', {'bar': 'a', 'foo': 'a'})))
+        self.expectThat(variables.lookups, Equals(['bar', 'foo', 'foo']))
+        self.expectThat(variables.variables, Equals({'foo': 'a'}))
+
+
+class TestEvaluateMany(TestCase):
+
+    def test_many(self):
+        results = evaluate_many(
+            "${foo:-$bar}", [{'foo': 'a'}, {'bar': 'b'}, {}])
+        self.expectThat(next(results), Equals(('a', {})))
+        self.expectThat(list(results), Equals([('b', {}), ('', {})]))
+
+    def test_many_skip(self):
+        self.expectThat(
+            list(evaluate_many("$foo", [{}, {'foo': 'a'}], SKIP)),
+            Equals([('$foo', {}), ('a', {})]))
+
+    def test_many_assignments_are_per_row(self):
+        variable_sets = [{}, {'foo': 'a'}, {}]
+        self.expectThat(
+            list(evaluate_many("${foo:=b}$foo", variable_sets)),
+            Equals([('bb', {'foo': 'b'}), ('aa', {'foo': 'a'}),
+                    ('bb', {'foo': 'b'})]))
+        self.expectThat(variable_sets, Equals([{}, {'foo': 'a'}, {}]))
+
+    def test_many_invalid_absent(self):
+        self.expectThat(
+            lambda: evaluate_many("$foo", [], None),
+            raises(ValueError("invalid value for absent None")))
+
+    def test_columns(self):
+        results = evaluate_columns(
+            "$host:${port:-80}",
+            {'host': ['a', 'b'], 'port': ['8080', '']})
+        self.expectThat(
+            list(results), Equals([('a:8080', {}), ('b:80', {})]))
+
+    def test_columns_no_rows(self):
+        self.expectThat(list(evaluate_columns("$a", {'a': []})), Equals([]))
+
+    def test_columns_different_lengths(self):
+        self.expectThat(
+            lambda: evaluate_columns("$a", {'a': ['1', '2'], 'b': ['1']}),
+            Raises(MatchesException(
+                ValueError, "columns have different lengths .*")))
+
+
+class TestSpecialize(TestCase):
+
+    def check(self, expression, known, variables):
+        """Check that specializing then evaluating gives the same results."""
+        residual = compile(expression).specialize(known)
+        merged = dict(variables)
+        merged.update(known)
+        for absent in (EMPTY, SKIP):
+            try:
+                expected = evaluate(expression, merged, absent)
+            except EvaluationError as error:
+                self.expectThat(
+                    lambda: residual.evaluate(variables, absent),
+                    raises(error))
+            else:
+                self.expectThat(
+                    residual.evaluate(variables, absent), Equals(expected))
+        return residual
+
+    def test_folds_known_variables(self):
+        residual = self.check(
+            "$a:${b:-x}:${c:+$b}:$d", {'a': '1', 'b': '', 'c': 'y'},
+            {'d': '2'})
+        self.expectThat(
+            residual.nodes,
+            Equals([_Literal('1:x::'), _SimpleExpression('d', '$d')]))
+        self.expectThat(residual.analysis.referenced, Equals(set(['d'])))
+
+    def test_everything_known(self):
+        residual = self.check("${a:-$b}", {'a': '', 'b': 'x'}, {})
+        self.expectThat(residual.nodes, Equals([_Literal('x')]))
+
+    def test_known_take_precedence(self):
+        self.expectThat(
+            compile("$a$b").specialize({'a': '1'}).evaluate(
+                {'a': '2', 'b': '3'}),
+            Equals(('13', {})))
+
+    def test_unknown_expressions_are_kept(self):
+        residual = self.check("${a:-$b}", {'b': 'x'}, {})
+        self.expectThat(
+            residual.nodes,
+            Equals([_Expression('a', ':', '-', [_Literal('x')])]))
+        self.check("${a:-$b}", {'b': 'x'}, {'a': 'y'})
+
+    def test_assignments(self):
+        residual = self.check("${a:=x}$a$b", {'a': ''}, {'b': 'y'})
+        self.expectThat(
+            residual.nodes,
+            Equals([_Literal('xx'), _SimpleExpression('b', '$b')]))
+        self.expectThat(
+            residual.evaluate({'a': 'z'}), Equals(('xx', {'a': 'x'})))
+
+    def test_conditional_assignments(self):
+        # Whether a is assigned depends on b, so a is looked up at runtime.
+        for variables in ({}, {'b': 'y'}):
+            self.check("$a${b:-${a:=x}}$a", {'a': ''}, variables)
+        self.check("${a:=$b}$a", {'a': ''}, {'b': 'y'})
+        self.check("${a:?${a:=$b}}", {'a': ''}, {'b': 'y'})
+
+    def test_skip_keeps_original_text(self):
+        residual = compile("${a:-${b:-$c}}").specialize({'b': ''})
+        self.expectThat(
+            residual.evaluate({}, SKIP), Equals(("${a:-${b:-$c}}", {})))
+
+    def test_errors(self):
+        self.check("${a:?$b bad}", {'a': ''}, {'b': 'very'})
+        self.check("${a:?bad}", {'a': ''}, {})
+        self.check("${a:?bad}", {}, {})
+
+    def test_bytes(self):
+        residual = self.check(
+            b"${a:-\xff}$b", {b'a': b''}, {b'b': b'\xfe'})
+        self.expectThat(
+            residual.nodes,
+            Equals([_Literal(b'\xff'), _SimpleExpression(b'b', b'$b')]))
+
+    def test_codegen(self):
+        residual = compile("$a$b", CODEGEN).specialize({'a': '1'})
+        self.expectThat(residual.evaluate({'b': '2'}), Equals(('12', {})))
+
+    def test_twice(self):
+        residual = compile("${a:=x}$b$c").specialize({'a': ''})
+        residual = residual.specialize({'b': '1'})
+        self.expectThat(
+            residual.evaluate({'c': '2'}), Equals(('x12', {'a': 'x'})))
+
+    def test_many(self):
+        residual = compile("$a$b").specialize({'a': '1'})
+        self.expectThat(
+            list(residual.evaluate_many([{'b': '2'}, {}])),
+            Equals([('12', {}), ('1', {})]))
+
+    def test_instrumented(self):
+        instrumentation = Instrumentation()
+        residual = compile("$a$b").specialize({'a': '1'})
+        previous = instrument(instrumentation)
+        try:
+            residual.evaluate({'b': '2'})
+        finally:
+            instrument(previous)
+        self.expectThat(instrumentation.snapshot()['lookups'], Equals(1))
+
+
+class TestEvaluateStream(TestCase):
+
+    def check(self, text, variables, absent=EMPTY):
+        expected = evaluate(text, variables, absent)
+        for chunk_size in range(1, len(text) + 2):
+            writer = io.StringIO()
+            assignments = evaluate_stream(
+                io.StringIO(text), writer, variables, absent, chunk_size)
+            self.expectThat(
+                (writer.getvalue(), assignments), Equals(expected),
+                "chunk_size %d" % (chunk_size,))
+
+    def test_empty(self):
+        self.check(u'', {})
+
+    def test_expressions_across_chunks(self):
+        self.check(u'pre $foo ${bar} mid $foo$bar post', {u'foo': u'a'})
+        self.check(u'$foo $fo $f$', {u'foo': u'a', u'f': u'b'}, SKIP)
+
+    def test_nested_expressions_across_chunks(self):
+        self.check(
+            u'a ${foo:-${bar:=${baz:+x}}}y} $bar ${bar:-z}', {u'baz': u'1'})
+
+    def test_unclosed_expressions(self):
+        self.check(u'a ${foo:-${bar:=x} $bar', {})
+        self.check(u'a ${foo:-$bar', {u'bar': u'b'})
+        self.check(u'${foo ${foo: ${foo:- $', {})
+
+    def test_assignments_carry_across_chunks(self):
+        self.check(u'${foo:=a}' + u' ' * 10 + u'$foo', {})
+
+    def test_bytes(self):
+        output = io.BytesIO()
+        assignments = evaluate_stream(
+            io.BytesIO(b"\xff${a:=x} $a ${b:-\xfe}"), output, {},
+            chunk_size=3)
+        self.expectThat(assignments, Equals({b"a": b"x"}))
+        self.expectThat(output.getvalue(), Equals(b"\xffx x \xfe"))
+
+    def test_invalid_chunk_size(self):
+        for chunk_size in (0, -1):
+            self.expectThat(
+                lambda: evaluate_stream(
+                    io.StringIO(u'$a'), io.StringIO(), {},
+                    chunk_size=chunk_size),
+                raises(ValueError("invalid chunk size %r" % (chunk_size,))))
+
+
+class TestAnalyze(TestCase):
+
+    def test_empty(self):
+        self.expectThat(
+            analyze("literal"),
+            Equals(Analysis(frozenset(), frozenset(), frozenset())))
+
+    def test_nested(self):
+        self.expectThat(
+            analyze("$a ${b} ${c:-${d:=${e?$f}}} ${g+${h:?}} ${i=}"),
+            Equals(Analysis(
+                frozenset('abcdefghi'), frozenset('di'), frozenset('eh'))))
+
+    def test_template_property(self):
+        template = compile("${a:=$b}")
+        self.expectThat(template.analysis, Is(analyze("${a:=$b}")))
+        self.expectThat(template.analysis.referenced, Equals(set('ab')))
+        self.expectThat(template.analysis.assigned, Equals(set('a')))
+        self.expectThat(template.analysis.required, Equals(set()))
+
+
+class TestResultCache(TestCase):
+
+    def test_caches_on_referenced_variables(self):
+        cache = ResultCache(compile("$foo ${bar:-baz}"))
+        self.expectThat(
+            cache.evaluate({'foo': 'a', 'other': '1'}),
+            Equals(('a baz', {})))
+        self.expectThat(
+            cache.evaluate(LookupOnly({'foo': 'a', 'other': '2'})),
+            Equals(('a baz', {})))
+        self.expectThat(
+            cache.evaluate({'foo': 'a', 'bar': 'b'}),
+            Equals(('a b', {})))
+        self.expectThat(cache.info(), Equals(CacheInfo(1, 2, 0, 1024, 2)))
+
+    def test_absent_is_part_of_key(self):
+        cache = ResultCache(compile("$foo"))
+        self.expectThat(cache.evaluate({}), Equals(('', {})))
+        self.expectThat(cache.evaluate({}, SKIP), Equals(('$foo', {})))
+
+    def test_alternative_keys_on_state(self):
+        cache = ResultCache(compile("${foo:+x}${bar+y}"))
+        self.expectThat(
+            cache.evaluate({'foo': 'a', 'bar': ''}), Equals(('xy', {})))
+        self.expectThat(
+            cache.evaluate({'foo': 'b', 'bar': ''}), Equals(('xy', {})))
+        self.expectThat(cache.evaluate({'foo': ''}), Equals(('', {})))
+        self.expectThat(cache.info().hits, Equals(1))
+
+    def test_alternative_and_value(self):
+        cache = ResultCache(compile("${foo:+$foo}"))
+        self.expectThat(cache.evaluate({'foo': 'a'}), Equals(('a', {})))
+        self.expectThat(cache.evaluate({'foo': 'b'}), Equals(('b', {})))
+
+    def test_assignments_are_copied(self):
+        cache = ResultCache(compile("${foo:=bar}"))
+        result = cache.evaluate({})
+        result[1]['foo'] = 'changed'
+        self.expectThat(cache.evaluate({}), Equals(('bar', {'foo': 'bar'})))
+
+    def test_errors_are_cached(self):
+        cache = ResultCache(compile("${foo:?missing}"))
+        for _ in range(2):
+            self.expectThat(
+                lambda: cache.evaluate({}),
+                raises(EvaluationError("missing")))
+        self.expectThat(cache.info().hits, Equals(1))
+
+    def test_unhashable_values_are_not_cached(self):
+        class Unhashable(str):
+            __hash__ = None
+        cache = ResultCache(compile("$foo"))
+        self.expectThat(
+            cache.evaluate({'foo': Unhashable('a')}), Equals(('a', {})))
+        self.expectThat(cache.info().currsize, Equals(0))
+
+    def test_bounded(self):
+        cache = ResultCache(compile("$foo"), maxsize=2)
+        for value in 'abc':
+            cache.evaluate({'foo': value})
+        self.expectThat(cache.info(), Equals(CacheInfo(0, 3, 1, 2, 2)))
+        cache.clear()
+        self.expectThat(cache.info(), Equals(CacheInfo(0, 0, 0, 2, 0)))
+
+
+class TestInstrumentation(TestCase):
+
+    scenarios = [
+        ('interpret', {'backend': INTERPRET}),
+        ('codegen', {'backend': CODEGEN}),
+        ]
+
+    def setUp(self):
+        super(TestInstrumentation, self).setUp()
+        self.events = []
+        self.instrumentation = Instrumentation(
+            lambda event, data: self.events.append((event, data)))
+        self.addCleanup(instrument, instrument(self.instrumentation))
+        self.addCleanup(cache_clear)
+        cache_clear()
+
+    def test_records(self):
+        template = compile("$a ${b:-${c:=x}} ${d+y}", self.backend)
+        self.expectThat(
+            template.evaluate({'a': 'A', 'd': ''}),
+            Equals(('A x y', {'c': 'x'})))
+        self.expectThat(
+            template.evaluate({'a': 'A'}, SKIP),
+            Equals(('A ${b:-${c:=x}} ${d+y}', {})))
+        stats = self.instrumentation.snapshot()
+        self.expectThat(stats['parses'], Equals(1))
+        self.expectThat(stats['parse_input_size'], Equals(23))
+        self.expectThat(stats['evaluations'], Equals(2))
+        self.expectThat(stats['evaluate_input_size'], Equals(46))
+        self.expectThat(stats['evaluate_output_size'], Equals(5 + 22))
+        self.expectThat(stats['lookups'], Equals(4 + 3))
+        self.expectThat(
+            stats['nodes'],
+            Equals({'$': 2, '-': 2, '=': 1, '?': 0, '+': 2}))
+        self.expectThat(stats['errors'], Equals(0))
+        self.expectThat(
+            [event for event, _ in self.events],
+            Equals(['parse', 'evaluate', 'evaluate']))
+        self.expectThat(self.events[1][1]['lookups'], Equals(4))
+
+    def test_errors(self):
+        self.expectThat(
+            lambda: evaluate("${a:?}", {}),
+            raises(EvaluationError("Variable 'a' null or unset.")))
+        stats = self.instrumentation.snapshot()
+        self.expectThat(stats['errors'], Equals(1))
+        self.expectThat(stats['nodes']['?'], Equals(1))
+        self.expectThat(self.events[-1][1]['error'], Equals(True))
+
+    def test_stream(self):
+        text = u'${a:=x} $a ${b:-y} ${c'
+        output = io.StringIO()
+        assignments = evaluate_stream(
+            io.StringIO(text), output, {}, chunk_size=4)
+        self.expectThat(output.getvalue(), Equals(u'x x y ${c'))
+        self.expectThat(assignments, Equals({'a': 'x'}))
+        stats = self.instrumentation.snapshot()
+        self.expectThat(stats['parses'], GreaterThan(1))
+        self.expectThat(stats['evaluate_input_size'], Equals(len(text)))
+        self.expectThat(stats['evaluate_output_size'], Equals(9))
+        self.expectThat(stats['lookups'], Equals(3))
+        self.expectThat(
+            stats['nodes'],
+            Equals({'$': 1, '-': 1, '=': 1, '?': 0, '+': 0}))
+
+    def test_reset_and_disable(self):
+        evaluate("$a", {})
+        self.instrumentation.reset()
+        self.expectThat(
+            self.instrumentation.snapshot()['evaluations'], Equals(0))
+        instrument(None)
+        evaluate("$b", {})
+        self.expectThat(self.instrumentation.snapshot()['parses'], Equals(0))
+
+
+class TestCache(TestCase):
+
+    def setUp(self):
+        super(TestCache, self).setUp()
+        maxsize = cache_info().maxsize
+        self.addCleanup(set_cache_size, maxsize)
+        self.addCleanup(cache_clear)
+        cache_clear()
+
+    def test_evaluate_uses_cache(self):
+        evaluate("$foo", {'foo': 'bar'})
+        evaluate("$foo", {'foo': 'baz'})
+        evaluate("$bar", {})
+        self.expectThat(cache_info(), Equals(CacheInfo(1, 2, 0, 2048, 2)))
+
+    def test_compile_uses_cache(self):
+        template = compile("$foo")
+        self.expectThat(compile("$foo"), Is(template))
+
+    def test_evicts_least_recently_used(self):
+        set_cache_size(2)
+        first = compile("$a")
+        compile("$b")
+        compile("$a")
+        compile("$c")
+        self.expectThat(cache_info(), Equals(CacheInfo(1, 3, 1, 2, 2)))
+        self.expectThat(compile("$a"), Is(first))
+        compile("$b")
+        self.expectThat(cache_info(), Equals(CacheInfo(2, 4, 2, 2, 2)))
+
+    def test_shrinking_evicts(self):
+        for name in 'abcd':
+            compile('$' + name)
+        set_cache_size(1)
+        self.expectThat(cache_info(), Equals(CacheInfo(0, 4, 3, 1, 1)))
+
+    def test_zero_disables(self):
+        set_cache_size(0)
+        self.expectThat(evaluate("$a", {'a': 'b'}), Equals(('b', {})))
+        self.expectThat(cache_info(), Equals(CacheInfo(0, 1, 0, 0, 0)))
+
+    def test_invalid_size(self):
+        self.expectThat(
+            lambda: set_cache_size(-1),
+            raises(ValueError("invalid cache size -1")))
+
+    def test_clear(self):
+        compile("$a")
+        compile("$a")
+        cache_clear()
+        self.expectThat(
+            cache_info(), Equals(CacheInfo(0, 0, 0, 2048, 0)))
+
+
+class TestThreads(TestCase):
+
+    threads = 8
+
+    def setUp(self):
+        super(TestThreads, self).setUp()
+        maxsize = cache_info().maxsize
+        self.addCleanup(set_cache_size, maxsize)
+        self.addCleanup(cache_clear)
+        cache_clear()
+
+    def run_threads(self, function):
+        """Call function(index) in each of several threads at once.
+
+        :return: The return values, by index.
+        """
+        start = threading.Event()
+        results = [None] * self.threads
+        errors = []
+
+        def run(index):
+            start.wait()
+            try:
+                results[index] = function(index)
+            except Exception as error:
+                errors.append(error)
+
+        threads = [
+            threading.Thread(target=run, args=(index,))
+            for index in range(self.threads)]
+        for thread in threads:
+            thread.start()
+        start.set()
+        for thread in threads:
+            thread.join()
+        self.expectThat(errors, Equals([]))
+        return results
+
+    def test_compile(self):
+        set_cache_size(8)
+        expressions = ['$a%d' % i for i in range(16)]
+
+        def compile_all(index):
+            for i in range(1000):
+                expression = expressions[(i + index) % len(expressions)]
+                if compile(expression).expression != expression:
+                    return expression
+
+        self.expectThat(self.run_threads(compile_all), Equals(
+            [None] * self.threads))
+        info = cache_info()
+        self.expectThat(info.hits + info.misses, Equals(1000 * self.threads))
+        self.expectThat(info.currsize, Equals(8))
+
+    def test_compile_gives_one_template(self):
+        templates = self.run_threads(lambda index: compile("${a:-b}"))
+        self.expectThat(len(set(map(id, templates))), Equals(1))
+
+    def test_evaluate(self):
+        template = compile("${a:=$b}$a")
+
+        def evaluate_all(index):
+            value = str(index)
+            expected = (value * 2, {'a': value})
+            for _ in range(1000):
+                result = template.evaluate({'b': value})
+                if result != expected:
+                    return result
+
+        self.expectThat(
+            self.run_threads(evaluate_all), Equals([None] * self.threads))
+
+
 class TestGrammar(TestCase):
 
     def test_name(self):
@@ -262,19 +924,16 @@ class TestGrammar(TestCase):
             ('$a1', _SimpleExpression('a1', '$a1')),
             ('${ab}', _SimpleExpression('ab', '${ab}')),
             ('${ab:-}', 
-                _Expression('ab', ':', '-', [], '${ab:-}')),
+                _Expression('ab', ':', '-', [])),
             ('${ab:-${foo}}', 
-                _Expression('ab', ':', '-', [_SimpleExpression('foo', '${foo}')],
-                            '${ab:-${foo}}')),
+                _Expression('ab', ':', '-', [_SimpleExpression('foo', '${foo}')])),
             ('${ab:-${cd:-${foo}}}', 
                 _Expression(
                     'ab', ':', '-',
                     [_Expression(
                         'cd', ':', '-',
-                        [_SimpleExpression('foo', '${foo}')],
-                        '${cd:-${foo}}'),
-                        ],
-                    '${ab:-${cd:-${foo}}}')),
+                        [_SimpleExpression('foo', '${foo}')]),
+                        ])),
             ):
             g = _grammar(text)
             self.expectThat(g.expr(), Equals(node))
@@ -318,12 +977,138 @@ class TestGrammar(TestCase):
                     'ab', ':', '-',
                     [_Expression(
                         'cd', ':', '-',
-                        [_SimpleExpression('foo', '${foo}')],
-                        '${cd:-${foo}}'),
-                        ],
-                    '${ab:-${cd:-${foo}}}'),
+                        [_SimpleExpression('foo', '${foo}')]),
+                        ]),
                 _Literal('2'),
                 ]),
             ):
             g = _grammar(text)
             self.expectThat(g.string(), Equals(nodes))
+
+
+class TestScan(TestCase):
+
+    def check(self, text):
+        nodes = _scan(text)
+        self.expectThat(nodes, Equals(_grammar(text).string()))
+        self.expectThat(''.join(map(_source, nodes)), Equals(text))
+        self.expectThat(
+            _disassemble(_assemble(text, nodes)), Equals(nodes))
+
+    def test_matches_grammar(self):
+        for text in (
+            '', '$', '$$', '$1', '${', '${}', '${a', '${a}', '${a:', '${a:}',
+            '${a:-', '${a:-b', '${a:-b}', '${a-b}', '${a:=b}', '${a?}',
+            '${a:+b}', '${a:*b}', '}', 'a}b', '${a:-b}}', '$a}', '${a:-}}',
+            '${a:-${b}', '${a:-${b:-c}', '${a:-${b:-c}}', '${a:-$b}c}',
+            'x${a:-y${b:-z', 'x${a:-y${b}z${c:-w', '${a:-${b:-${c}}}',
+            '${a:-{b}}', '$_a1 $é1²', '${_:=$_}', '${a:-$b${c:-}}d',
+            '${a:-${b:-${c:-d}}', '${a:-x${b:-y}z', 'x${a:-${b:-${c:-',
+            ):
+            self.check(text)
+
+    @given(st.text(alphabet='${}:-=?+ab_1 \xe9'))
+    def test_hypothesis(self, text):
+        self.check(text)
+
+
+class TestDeepNesting(TestCase):
+
+    # Deep enough to exceed the recursion limit many times over.
+    depths = (10000, 100000)
+
+    def nested(self, depth, op=':-', inner='x'):
+        return '${a%s' % (op,) * depth + inner + '}' * depth
+
+    def test_evaluate(self):
+        for depth in self.depths:
+            expression = self.nested(depth)
+            self.expectThat(evaluate(expression, {}), Equals(('x', {})))
+            self.expectThat(
+                evaluate(expression, {'a': 'y'}), Equals(('y', {})))
+            self.expectThat(
+                compile(expression, CODEGEN).evaluate({}),
+                Equals(('x', {})))
+
+    def test_assign(self):
+        for depth in self.depths:
+            expression = self.nested(depth, '=')
+            self.expectThat(
+                evaluate(expression, {}), Equals(('x', {'a': 'x'})))
+
+    def test_skip(self):
+        for depth in self.depths:
+            expression = self.nested(depth)
+            self.expectThat(
+                evaluate(expression, {}, SKIP), Equals((expression, {})))
+
+    def test_error(self):
+        expression = self.nested(self.depths[-1], ':?', 'bad')
+        self.expectThat(
+            lambda: evaluate(expression, {}),
+            raises(EvaluationError('bad')))
+
+    def test_unclosed(self):
+        for depth in self.depths:
+            expression = '${a:-$b' * depth
+            nodes = _scan(expression)
+            self.expectThat(len(nodes), Equals(2 * depth))
+            self.expectThat(
+                evaluate(expression, {'b': 'c'}),
+                Equals(('${a:-c' * depth, {})))
+
+    def test_analyze(self):
+        expression = self.nested(self.depths[-1], inner='$b')
+        self.expectThat(
+            analyze(expression),
+            Equals(Analysis(
+                frozenset(['a', 'b']), frozenset(), frozenset())))
+        cache = ResultCache(compile(expression))
+        self.expectThat(cache.evaluate({'b': 'c'}), Equals(('c', {})))
+
+    def test_stream(self):
+        for depth in self.depths:
+            expression = self.nested(depth)
+            output = io.StringIO()
+            evaluate_stream(
+                io.StringIO(expression), output, {'a': ''}, chunk_size=100)
+            self.expectThat(output.getvalue(), Equals('x'))
+
+    def test_specialize(self):
+        expression = self.nested(self.depths[-1], ':-', '$b')
+        self.expectThat(
+            compile(expression).specialize({'a': ''}).nodes,
+            Equals([_SimpleExpression('b', '$b')]))
+        residual = compile(expression).specialize({'b': 'x'})
+        self.expectThat(residual.evaluate({}), Equals(('x', {})))
+
+
+class TestImport(TestCase):
+
+    # The most importing shellvars may take, in seconds.
+    budget = 0.1
+
+    def test_import_is_cheap(self):
+        script = (
+            "import sys, time\n"
+            "start = time.time()\n"
+            "import shellvars\n"
+            "print(time.time() - start)\n"
+            "print('parsley' in sys.modules)\n"
+            "print('shellvars.catalogue' in sys.modules)\n")
+        output = subprocess.check_output([sys.executable, '-c', script])
+        duration, parsley_imported, catalogue_imported = (
+            output.decode('ascii').split())
+        self.expectThat(parsley_imported, Equals('False'))
+        if sys.version_info >= (3, 7):
+            self.expectThat(catalogue_imported, Equals('False'))
+        self.expectThat(float(duration), LessThan(self.budget))
+
+    def test_lazy_names(self):
+        import shellvars
+        for name in ('BulkResult', 'Catalogue', 'CycleError', 'Environment'):
+            self.expectThat(name in shellvars.__all__, Equals(True))
+            self.expectThat(
+                getattr(shellvars, name).__name__, Equals(name))
+        self.expectThat(
+            lambda: shellvars.no_such_name, raises(AttributeError))